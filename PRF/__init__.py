@@ -1 +1,4 @@
 from .prf import *
+from .cache import PRFCache, warm_cache
+from .bank import PRFBank, get_bank, compile_bank, reshape_prf, interleave_prf
+from .parallel import locate_parallel
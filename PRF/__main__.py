@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line tools for the local TESS PRF files:
+
+    python -m PRF warm [--cams 1 2] [--ccds 3 4] [--sectors 4] [--cachedir DIR] [--url URL] [--threads 8]
+
+pre-populates the local PRF cache, so that later runs do not need network
+access to build PRFs, and
+
+    python -m PRF compile BANKDIR [--cams 1 2] [--ccds 3 4] [--sectors 4]
+
+compiles the PRF grids into memory-mappable banks, to be used as
+TESS_PRF(..., bankdir=BANKDIR).
+"""
+import argparse
+from .cache import warm_cache, N_THREADS
+from .bank import compile_bank
+
+parser = argparse.ArgumentParser(prog='python -m PRF',
+                                 description='Manage the local TESS PRF files.')
+subparsers = parser.add_subparsers(dest='command', required=True)
+warm = subparsers.add_parser('warm', help='pre-populate the local PRF cache')
+warm.add_argument('--url', default=None, help='server holding the PRF files (default: $TESS_PRF_URL, or MAST)')
+warm.add_argument('--threads', type=int, default=N_THREADS, help='concurrent downloads')
+compile_ = subparsers.add_parser('compile', help='compile memory-mappable PRF banks')
+compile_.add_argument('bankdir')
+compile_.add_argument('--localdatadir', default=None,
+                      help='read pre-downloaded PRFs instead of the MAST cache')
+for subparser in [warm, compile_]:
+    subparser.add_argument('--cams', type=int, nargs='+', default=[1,2,3,4])
+    subparser.add_argument('--ccds', type=int, nargs='+', default=[1,2,3,4])
+    subparser.add_argument('--sectors', type=int, nargs='+', default=[1,4],
+                           help='any sector of each PRF epoch (default: 1 4)')
+    subparser.add_argument('--cachedir', default=None)
+args = parser.parse_args()
+
+if args.command == 'warm':
+    warm_cache(args.cams, args.ccds, args.sectors, args.cachedir, base_url=args.url,
+               n_threads=args.threads)
+if args.command == 'compile':
+    for sector in args.sectors:
+        for cam in args.cams:
+            for ccd in args.ccds:
+                print('Compiled ' + compile_bank(cam, ccd, sector, args.bankdir,
+                                                 localdatadir=args.localdatadir,
+                                                 cachedir=args.cachedir))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-memory bank of the full TESS PRF grid of one epoch/cam/ccd.
+
+MAST provides the PRF models on a grid of detector locations (5x5 for each
+camera/CCD). PRFBank loads all of them once, together with their
+"un-interleaved" 11x11x13x13 form used by TESS_PRF.locate. Since both the
+bilinear mix between grid nodes and the reshaping are linear, a PRF at any
+(colnum, rownum) is then just a weighted sum of four cached tensors.
+
+Banks are shared process-wide through get_bank. They can also be compiled
+once (compile_bank, or `python -m PRF compile`) into a .npy file holding the
+reshaped models of all grid nodes, plus a small .index.npy file with their
+(col,row) positions. Compiled banks are memory-mapped, so processes using
+the same bank directory share its pages through the OS cache instead of each
+parsing FITS files and re-interleaving.
+"""
+import numpy as np
+import os
+from glob import glob
+from .cache import PRFCache, prf_epoch
+from .stamps import split_positions, subpixel_weights, place_stamps, prf_envelope
+
+def reshape_prf(prf):
+    """Un-interleave 117x117 PRF models into their 11x11x13x13 form
+
+    indices: subrow index (from bottom), subcol index (from left),
+    TPF row index (from bottom), TPF col index (from left), with the models
+    just beyond the pixel edges added. Any leading dimensions of `prf` are
+    kept, i.e. (..., 117, 117) -> (..., 11, 11, 13, 13).
+    """
+    prf = np.asarray(prf, dtype=float)
+    lead = prf.shape[:-2]
+    reshaped = np.zeros(lead + (11,11,13,13))
+
+    #Un-interleve PRF samples: reshaped[...,i+1,j+1,:,:] = prf[...,8-i::9,8-j::9]
+    interleaved = prf.reshape(lead + (13,9,13,9))
+    interleaved = np.moveaxis(interleaved, (-4,-3,-2,-1), (-2,-4,-1,-3))
+    reshaped[...,1:10,1:10,:,:] = interleaved[...,::-1,::-1,:,:]
+
+    #Add columns just beyond pixel edges
+    reshaped[...,1:10,0,:,:-1] = reshaped[...,1:10,-2,:,1:]
+    reshaped[...,1:10,-1,:,1:] = reshaped[...,1:10,1,:,:-1]
+
+    #Add rows just beyond pixel edges
+    reshaped[...,0,:,:-1,:] = reshaped[...,-2,:,1:,:]
+    reshaped[...,-1,:,1:,:] = reshaped[...,1,:,:-1,:]
+    return reshaped
+
+def interleave_prf(reshaped):
+    """Inverse of reshape_prf: (..., 11, 11, 13, 13) -> (..., 117, 117)"""
+    reshaped = np.asarray(reshaped)
+    lead = reshaped.shape[:-4]
+    interleaved = reshaped[...,1:10,1:10,:,:][...,::-1,::-1,:,:]
+    interleaved = np.moveaxis(interleaved, (-2,-4,-1,-3), (-4,-3,-2,-1))
+    return interleaved.reshape(lead + (117,117))
+
+def bank_filename(cam, ccd, sector):
+    """Name of the compiled bank file for a camera/CCD and sector"""
+    return f'prfbank_{prf_epoch(sector)}_cam{int(cam)}_ccd{int(ccd)}.npy'
+
+class PRFBank:
+    """All TESS PRF models of one epoch/cam/ccd, held in memory
+
+    """
+    def __init__(self, cam, ccd, sector, localdatadir=None, cachedir=None):
+        """Load every PRF grid node for a camera/CCD.
+
+        inputs:
+         - cam (int): TESS camera number
+         - ccd (int): TESS ccd number
+         - sector (int): TESS sector number
+         - localdatadir (str, default None): directory with pre-downloaded
+           PRFs (see TESS_PRF); by default files come from the MAST cache
+         - cachedir (str, default None): root of the local PRF cache
+        """
+        self.cam, self.ccd, self.epoch = int(cam), int(ccd), prf_epoch(sector)
+        subdir = f'cam{self.cam}_ccd{self.ccd}/'
+        if localdatadir is None:
+            filelist = PRFCache(cam, ccd, sector, cachedir=cachedir).paths()
+        else:
+            filelist = glob(os.path.join(localdatadir, subdir) + '*.fits')
+        #One directory on MAST has some errant files with `phot` in filename
+        filelist = sorted([file for file in filelist if 'phot' not in file])
+
+        from astropy.io import fits
+        self.cols = np.array([int(file[-9:-5]) for file in filelist])
+        self.rows = np.array([int(file[-17:-13]) for file in filelist])
+        prfs = []
+        for file in filelist:
+            with fits.open(file) as hdulist:
+                prfs.append(np.array(hdulist[0].data, dtype=float))
+        self.reshaped = reshape_prf(np.array(prfs)) #(nodes, 11, 11, 13, 13)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Memory-map a bank compiled with compile_bank"""
+        bank = cls.__new__(cls)
+        name = os.path.basename(filename)[:-len('.npy')].split('_')
+        bank.epoch = '_'.join(name[1:3])
+        bank.cam, bank.ccd = int(name[3][3:]), int(name[4][3:])
+        bank.cols, bank.rows = np.load(filename[:-len('.npy')] + '.index.npy')
+        bank.reshaped = np.load(filename, mmap_mode='r')
+        return bank
+
+    def save(self, filename):
+        """Write the bank as a memory-mappable .npy file plus its index"""
+        base = filename[:-len('.npy')]
+        for path, data in [(base + '.index.npy', np.array([self.cols, self.rows])),
+                           (filename, np.asarray(self.reshaped))]:
+            #write to a temporary file first, so that processes memory-mapping
+            #the bank never see a half-written file
+            tmp = f'{base}.{os.getpid()}.tmp.npy'
+            np.save(tmp, data)
+            os.replace(tmp, path)
+
+    def weights(self, colnum, rownum):
+        """Bilinear interpolation weights between the four surrounding PRFs
+
+        returns (indices, weights): grid node indices of the lower left,
+        lower right, upper left and upper right PRFs, and their weights
+        """
+        inds, weights = self.weights_many([colnum], [rownum])
+        return inds[0], weights[0]
+
+    def weights_many(self, colnums, rownums):
+        """Vectorized `weights` for many detector locations
+
+        returns (indices, weights), both of shape (N,4)
+        """
+        cols, rows = self.cols[None,:], self.rows[None,:]
+        colnums = np.asarray(colnums, dtype=float)[:,None]
+        rownums = np.asarray(rownums, dtype=float)[:,None]
+        quadrants = [(rows < rownums) & (cols < colnums), #lower left
+                     (rows > rownums) & (cols < colnums), #lower right
+                     (rows < rownums) & (cols > colnums), #upper left
+                     (rows > rownums) & (cols > colnums)] #uppper right
+        if not np.all([np.any(quadrant, axis=1) for quadrant in quadrants]):
+            raise ValueError('No surrounding PRF models for some detector locations')
+        dist = np.sqrt((rows-rownums)**2. + (cols-colnums)**2.)
+        inds = np.stack([np.argmin(np.where(quadrant, dist, np.inf), axis=1)
+                         for quadrant in quadrants], axis=1)
+
+        #Following https://stackoverflow.com/a/8662355
+        colnums, rownums = colnums[:,0], rownums[:,0]
+        x1, y1 = self.cols[inds[:,0]], self.rows[inds[:,0]]
+        x2, y2 = self.cols[inds[:,3]], self.rows[inds[:,3]]
+        weights = np.stack([(x2 - colnums) * (y2 - rownums),
+                            (x2 - colnums) * (rownums - y1),
+                            (colnums - x1) * (y2 - rownums),
+                            (colnums - x1) * (rownums - y1)], axis=1
+                           ) / ((x2 - x1) * (y2 - y1) + 0.0)[:,None]
+        return inds, weights
+
+    def prf(self, colnum, rownum):
+        """PRF model (117x117) and its 11x11x13x13 form at a detector location"""
+        inds, weights = self.weights(colnum, rownum)
+        reshaped = np.tensordot(weights, self.reshaped[inds], axes=1)
+        return interleave_prf(reshaped), reshaped
+
+    def envelope(self):
+        """Bound of any PRF of the bank vs distance to the source's pixel
+        (see prf_envelope)"""
+        return prf_envelope(self.reshaped)
+
+    def locate_many(self, colnums, rownums, sourcecols, sourcerows, facs,
+                    stampsize=(13,13), stack=False, sparse=False):
+        """Place many sources in a TPF, each with the PRF of its own pixel
+
+        Equivalent to building TESS_PRF(cam, ccd, sector, colnum, rownum) for
+        every source and calling its `locate`, but sources sharing a
+        detector pixel share their grid weights (through the inverse index
+        of np.unique), and all sources are interpolated at once from the
+        cached grid nodes.
+
+        colnums, rownums (arrays): detector pixel where the PRF of each
+            source is evaluated
+        sourcecols, sourcerows (arrays): positions of the stars (relative to TPF)
+        facs (array): flux of each star
+        stampsize (int,int): (height,width) of TPF
+        stack (bool): if True, return an (N,height,width) array with the
+            model of each star; by default return their sum
+        sparse (bool): if True, return the model of each star as the rows of
+            a scipy.sparse CSR matrix of shape (N, height*width)
+        """
+        colnums = np.asarray(colnums, dtype=float)
+        rownums = np.asarray(rownums, dtype=float)
+        colint, colfract, rowint, rowfract = split_positions(sourcecols, sourcerows)
+        finite = (np.isfinite(colfract) & np.isfinite(rowfract) &
+                  np.isfinite(colnums) & np.isfinite(rownums))
+
+        #grid node weights, computed once per unique detector pixel
+        pixels, inverse = np.unique(np.stack([colnums[finite], rownums[finite]], axis=1),
+                                    axis=0, return_inverse=True)
+        nodes, nodeweights = self.weights_many(pixels[:,0], pixels[:,1])
+        inverse = np.ravel(inverse)
+        nodes, nodeweights = nodes[inverse], nodeweights[inverse]
+
+        (rowbelow, rowabove, colbelow, colabove), subweights = subpixel_weights(
+            colfract[finite], rowfract[finite])
+
+        #interpolate, both between grid nodes and sub-pixel models
+        subsampled = np.zeros((len(nodes), 13, 13))
+        for k in range(4):
+            for w, r, c in zip(subweights,
+                               (rowbelow, rowabove, rowbelow, rowabove),
+                               (colbelow, colbelow, colabove, colabove)):
+                subsampled += (nodeweights[:,k] * w)[:,None,None] * self.reshaped[nodes[:,k], r, c]
+        #re-normalize to 1
+        subsampled /= np.sum(subsampled, axis=(1,2))[:,None,None]
+        subsampled *= np.asarray(facs, dtype=float)[finite][:,None,None]
+
+        stamps = np.zeros((len(finite), 13, 13))
+        stamps[finite] = subsampled
+        return place_stamps(stamps, colint, rowint, stampsize, stack=stack, sparse=sparse)
+
+def compile_bank(cam, ccd, sector, bankdir, localdatadir=None, cachedir=None):
+    """Compile the PRF grid of a camera/CCD into a bank file in bankdir
+
+    inputs:
+     - cam (int): TESS camera number
+     - ccd (int): TESS ccd number
+     - sector (int): any sector of the PRF epoch to compile
+     - bankdir (str): output directory
+     - localdatadir, cachedir: source of the PRF files (see PRFBank)
+
+    returns the path of the compiled bank
+    """
+    os.makedirs(bankdir, exist_ok=True)
+    filename = os.path.join(bankdir, bank_filename(cam, ccd, sector))
+    PRFBank(cam, ccd, sector, localdatadir=localdatadir, cachedir=cachedir).save(filename)
+    return filename
+
+#process-wide registry of loaded banks
+_banks = {}
+
+def get_bank(cam, ccd, sector, localdatadir=None, cachedir=None, bankdir=None):
+    """Shared PRFBank for a camera/CCD, loaded on first use
+
+    If bankdir is given, the bank compiled there with compile_bank is
+    memory-mapped instead of reading PRF FITS files.
+    """
+    if bankdir is not None:
+        key = os.path.abspath(os.path.join(bankdir, bank_filename(cam, ccd, sector)))
+        if key not in _banks:
+            _banks[key] = PRFBank.from_file(key)
+        return _banks[key]
+    key = (prf_epoch(sector), int(cam), int(ccd), localdatadir, cachedir)
+    if key not in _banks:
+        _banks[key] = PRFBank(cam, ccd, sector, localdatadir=localdatadir, cachedir=cachedir)
+    return _banks[key]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of the TESS PRF models hosted on MAST.
+
+The directory listings and PRF FITS files are stored under a local cache
+directory (default ~/.cache/tess_prf, or $TESS_PRF_CACHE), keyed by PRF epoch
+(start_s0001 for Sectors 1-3, start_s0004 for Sectors 4+), camera and CCD:
+
+    <cachedir>/<epoch>/cam#_ccd#/listing.json
+    <cachedir>/<epoch>/cam#_ccd#/<PRF file name>.fits
+
+The listing stores the SHA-256 of every downloaded file, which is checked
+before a cached file is trusted. Once a cam/ccd has been fetched, TESS_PRF
+does not touch the network again. To pre-populate all cameras and CCDs, run
+
+    python -m PRF warm
+
+All requests go through one shared requests.Session, which keeps the
+connections to the server alive, retries failed requests, and times out
+instead of hanging. The files of a cam/ccd are downloaded concurrently by a
+small thread pool. The server can be changed with $TESS_PRF_URL (or the
+base_url argument), e.g. to a local HTTP server mirroring the MAST directory
+layout. The network stack (requests, BeautifulSoup) is only imported when
+something has to be downloaded.
+"""
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MAST_PRF_URL = 'https://archive.stsci.edu/missions/tess/models/prf_fitsfiles/'
+TIMEOUT = 60 #seconds
+N_THREADS = 8 #concurrent downloads
+
+def prf_epoch(sector):
+    """MAST subdirectory with the PRF models appropriate for a sector
+
+    Different PRFs for Sectors 1-3, and 4+
+    https://heasarc.gsfc.nasa.gov/docs/tess/observing-technical.html#point-spread-function
+    """
+    if sector < 4:
+        return 'start_s0001'
+    return 'start_s0004'
+
+def default_cachedir():
+    """Local PRF cache directory ($TESS_PRF_CACHE, or ~/.cache/tess_prf)"""
+    return os.environ.get('TESS_PRF_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'tess_prf'))
+
+def prf_base_url():
+    """Server holding the PRF files ($TESS_PRF_URL, or MAST)"""
+    url = os.environ.get('TESS_PRF_URL', MAST_PRF_URL)
+    return url if url.endswith('/') else url + '/'
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Shared requests.Session, with connection pooling and retries"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=N_THREADS, max_retries=retries)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def fetch(url):
+    """Content of a URL, through the shared session"""
+    response = get_session().get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+def listFD(url, ext=''):
+    """List the files with extension ext in a MAST directory
+
+    https://stackoverflow.com/a/34718858
+    """
+    from bs4 import BeautifulSoup
+    page = fetch(url).decode()
+    soup = BeautifulSoup(page, 'html.parser')
+    return [url + '/' + node.get('href') for node in soup.find_all('a') if node.get('href').endswith(ext)]
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _atomic_write(path, data):
+    #write to a temporary file first so that interrupted runs never leave
+    #truncated files in the cache
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class PRFCache:
+    """Local copy of the MAST PRF files for one epoch/cam/ccd
+
+    """
+    def __init__(self, cam, ccd, sector, cachedir=None, base_url=None):
+        """Open (and create, if needed) the cache for a detector location.
+
+        inputs:
+         - cam (int): TESS camera number
+         - ccd (int): TESS ccd number
+         - sector (int): TESS sector number
+         - cachedir (str, default None): cache root directory (see default_cachedir)
+         - base_url (str, default None): server holding the PRF files (see prf_base_url)
+        """
+        self.cam, self.ccd, self.epoch = int(cam), int(ccd), prf_epoch(sector)
+        subdir = f'cam{self.cam}_ccd{self.ccd}'
+        base = base_url or prf_base_url()
+        self.url = base.rstrip('/') + '/' + self.epoch + '/' + subdir + '/'
+        self.directory = os.path.join(cachedir or default_cachedir(), self.epoch, subdir)
+        self.listingfile = os.path.join(self.directory, 'listing.json')
+        self._listing = None
+        self._lock = threading.Lock()
+
+    @property
+    def listing(self):
+        """dict of {file name: [url, sha256 or None]} for every PRF file"""
+        if self._listing is None:
+            if os.path.exists(self.listingfile):
+                with open(self.listingfile) as f:
+                    self._listing = json.load(f)
+            else:
+                #One directory on MAST has some errant files with `phot` in filename
+                urls = [url for url in listFD(self.url, 'fits') if 'phot' not in url]
+                self._listing = {os.path.basename(url): [url, None] for url in urls}
+                self._save_listing()
+        return self._listing
+
+    def _save_listing(self):
+        os.makedirs(self.directory, exist_ok=True)
+        _atomic_write(self.listingfile, json.dumps(self._listing, indent=1).encode())
+
+    def filenames(self):
+        """Names of all PRF files available for this epoch/cam/ccd"""
+        return sorted(self.listing)
+
+    def _cached(self, name):
+        url, sha = self.listing[name]
+        path = os.path.join(self.directory, name)
+        return sha is not None and os.path.exists(path) and _sha256(path) == sha
+
+    def _download(self, name):
+        url = self.listing[name][0]
+        content = fetch(url)
+        os.makedirs(self.directory, exist_ok=True)
+        _atomic_write(os.path.join(self.directory, name), content)
+        with self._lock:
+            self.listing[name][1] = hashlib.sha256(content).hexdigest()
+
+    def path(self, name):
+        """Local path of PRF file `name`, downloading it if it is not cached"""
+        if not self._cached(name):
+            self._download(name)
+            self._save_listing()
+        return os.path.join(self.directory, name)
+
+    def paths(self, names=None, n_threads=N_THREADS):
+        """Local paths of PRF files (default: all), downloading the missing
+        ones concurrently"""
+        names = self.filenames() if names is None else list(names)
+        missing = [name for name in names if not self._cached(name)]
+        if len(missing) > 0:
+            try:
+                with ThreadPoolExecutor(max_workers=max(min(n_threads, len(missing)), 1)) as executor:
+                    list(executor.map(self._download, missing))
+            finally:
+                #record the files downloaded so far, even if some failed
+                self._save_listing()
+        return [os.path.join(self.directory, name) for name in names]
+
+def warm_cache(cams=(1,2,3,4), ccds=(1,2,3,4), sectors=(1,4), cachedir=None, base_url=None,
+               n_threads=N_THREADS):
+    """Download all PRF files for the given cameras/CCDs into the local cache
+
+    inputs:
+     - cams (iterable of int): TESS camera numbers
+     - ccds (iterable of int): TESS ccd numbers
+     - sectors (iterable of int): any sector of each PRF epoch to fetch
+       (default (1,4): both the Sectors 1-3 and 4+ models)
+     - cachedir (str, default None): cache root directory
+     - base_url (str, default None): server holding the PRF files
+     - n_threads (int, default N_THREADS): concurrent downloads
+    """
+    for sector in sectors:
+        for cam in cams:
+            for ccd in ccds:
+                cache = PRFCache(cam, ccd, sector, cachedir=cachedir, base_url=base_url)
+                print(f'Caching {cache.epoch} cam{cam}_ccd{ccd} ({len(cache.filenames())} files)')
+                cache.paths(n_threads=n_threads)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-pool placement of many sources with any PRF model.
+
+locate_parallel splits the sources into fixed, contiguous chunks
+(np.array_split, so the split only depends on the number of sources and
+workers), places each chunk with the model's own `locate_many` in a worker
+process, and stacks the per-chunk sparse matrices back in order. Since the
+model of each source does not depend on the other sources, the result is
+identical to a single `locate_many(..., sparse=True)` call.
+
+The model (e.g. a PRFBank holding the whole PRF grid) is sent once to each
+worker, when the pool starts. Workers are forked: TESS-cont.py is a script
+without a `__main__` guard, which other start methods would re-run in every
+worker. Where fork is not available, the sources are placed serially.
+"""
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+def pool_context():
+    """multiprocessing context for worker pools (fork), or None if not available"""
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+def chunk_slices(n, n_chunks):
+    """Deterministic split of range(n) into at most n_chunks contiguous slices"""
+    bounds = np.cumsum([0] + [len(chunk) for chunk in np.array_split(np.arange(n), max(min(n_chunks, n), 1))])
+    return [slice(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+#model of the worker processes, set once by the pool initializer
+_model = None
+
+def _init_worker(model):
+    global _model
+    _model = model
+
+def _locate_chunk(arrays, stampsize):
+    return _model.locate_many(*arrays, stampsize, sparse=True)
+
+def locate_parallel(model, arrays, stampsize, n_workers=1, min_chunk=500):
+    """Place many sources with model.locate_many over a process pool
+
+    inputs:
+     - model: any object with a `locate_many(*arrays, stampsize, sparse=True)`
+       method (TESS_PRF, Gaussian_PRF, PRFBank)
+     - arrays (tuple of arrays): per-source positional arguments of
+       locate_many, e.g. (sourcecols, sourcerows, facs) for TESS_PRF, or
+       (colnums, rownums, sourcecols, sourcerows, facs) for PRFBank
+     - stampsize (int,int): (height,width) of TPF
+     - n_workers (int, default 1): worker processes
+     - min_chunk (int, default 500): minimum number of sources per worker;
+       smaller problems are placed serially
+
+    returns a scipy.sparse CSR matrix (sources x TPF pixels), as
+    locate_many(..., sparse=True)
+    """
+    from scipy.sparse import vstack, csr_matrix
+    arrays = tuple(np.asarray(array) for array in arrays)
+    n = len(arrays[0])
+    n_workers = min(int(n_workers), n // min_chunk)
+    context = pool_context()
+    if n_workers <= 1 or context is None:
+        return csr_matrix(model.locate_many(*arrays, stampsize, sparse=True))
+
+    #a few chunks per worker, to balance the load
+    slices = chunk_slices(n, 4*n_workers)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                             initializer=_init_worker, initargs=(model,)) as executor:
+        futures = [executor.submit(_locate_chunk, tuple(array[s] for array in arrays), stampsize)
+                   for s in slices]
+        chunks = [future.result() for future in futures]
+    return vstack(chunks, format='csr')
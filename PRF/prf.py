@@ -14,114 +14,54 @@ star at a specific location within the PRF (row/column relative to TPF corner).
 @author: keatonb
 """
 import numpy as np
-from bs4 import BeautifulSoup
-import requests
-from astropy.io import fits
-from scipy.interpolate import RectBivariateSpline
-import os
-from glob import glob
+from .bank import get_bank
+from .stamps import split_positions, subpixel_weights, place_stamps, prf_envelope, cull_sources
     
 class TESS_PRF:
     """TESS Pixel Response Function object
     
     """
-    def __init__(self,cam,ccd,sector,colnum,rownum, localdatadir = None):
+    def __init__(self,cam,ccd,sector,colnum,rownum, localdatadir = None, cachedir = None,
+                 bankdir = None):
         """Get TESS PRF for detector location, sector.
         
-        Downloads relevant PRF files from the MAST archive by default.
+        Downloads relevant PRF files from the MAST archive by default, keeping
+        a copy in a local cache (cachedir, default ~/.cache/tess_prf) so
+        that later calls do not need network access. The PRF grid of each
+        camera/CCD is read only once per process and shared by all instances.
         
         ***To use pre-downloaded local files, give directory containing
         subdirectories of format "cam#_ccd#/" as localdatadir, appropriate
         for sector of interest (separate for Sectors 1-3, 4+)
         
+        ***Alternatively, give a directory of PRF banks compiled with
+        `python -m PRF compile` as bankdir, which are memory-mapped
+        
         inputs:
          - cam (int): TESS camera number
          - ccd (int): TESS ccd number
          - sector (int): TESS sector number
          - colnum (float): column number near target
          - rownum (float): row number near target
+         - localdatadir (str, default None): directory with pre-downloaded PRFs
+         - cachedir (str, default None): root of the local PRF cache
+         - bankdir (str, default None): directory with compiled PRF banks
          
         """
         self.cam,self.ccd,self.sector,self.colnum,self.rownum = cam,ccd,sector,colnum,rownum
         self.prfnsamp = 9 #samples/pixel for TESS PRFs
         
-        #Get PRF file info
-        subdir = f'cam{int(cam)}_ccd{int(ccd)}/'
-        filelist = None #local and online options
-        
-        if localdatadir is None:
-            #Different PRFs for Sectors 1-3, and 4+
-            #https://heasarc.gsfc.nasa.gov/docs/tess/observing-technical.html#point-spread-function
-            if sector < 4:
-                url = 'https://archive.stsci.edu/missions/tess/models/prf_fitsfiles/start_s0001/' + subdir
-            else:
-                url = 'https://archive.stsci.edu/missions/tess/models/prf_fitsfiles/start_s0004/' + subdir
-            ext = 'fits'
-
-            #Get list of available PRF files
-            #https://stackoverflow.com/a/34718858
-            def listFD(url, ext=''):
-                page = requests.get(url).text
-                soup = BeautifulSoup(page, 'html.parser')
-                return [url + '/' + node.get('href') for node in soup.find_all('a') if node.get('href').endswith(ext)]
-
-            filelist = [file for file in listFD(url, ext)]
-        else:
-            filelist = glob(os.path.join(localdatadir, subdir) + '*.fits')
-        #One directory on MAST has some errant files with `phot` in filename
-        filelist = [file for file in filelist if 'phot' not in file]
-        
-        cols = np.array([int(file[-9:-5]) for file in filelist])
-        rows = np.array([int(file[-17:-13]) for file in filelist])
-
-        #Bilinear interpolation between four surrounding PRFs
-        LL = np.where((rows < rownum) & (cols < colnum))[0] #lower left
-        LR = np.where((rows > rownum) & (cols < colnum))[0] #lower right
-        UL = np.where((rows < rownum) & (cols > colnum))[0] #upper left
-        UR = np.where((rows > rownum) & (cols > colnum))[0] #uppper right
-        dist = np.sqrt((rows-rownum)**2. + (cols-colnum)**2.)
-        surroundinginds = [subset[np.argmin(dist[subset])] for subset in [LL,LR,UL,UR]]
-        #Following https://stackoverflow.com/a/8662355
-        points = []
-        for ind in surroundinginds:
-            hdulist = fits.open(filelist[ind])
-            prf = hdulist[0].data
-            points.append((cols[ind],rows[ind],prf))
-            hdulist.close()
-        points = sorted(points)
-        (x1, y1, q11), (_x1, y2, q12), (x2, _y1, q21), (_x2, _y2, q22) = points
-
-        self.prf = (q11 * (x2 - colnum) * (y2 - rownum) +
-                    q21 * (colnum - x1) * (y2 -  rownum) +
-                    q12 * (x2 - colnum) * ( rownum - y1) +
-                    q22 * (colnum - x1) * ( rownum - y1)
-                    ) / ((x2 - x1) * (y2 - y1) + 0.0)
-        
-        ## Need to reshape PRF file for interpolation
-        ## Add models just beyond pixel edges
+        #The PRF models of the whole camera/CCD grid are loaded only once per
+        #process (see PRF/bank.py); here we just mix the four surrounding ones
+        self.bank = get_bank(cam, ccd, sector, localdatadir=localdatadir, cachedir=cachedir,
+                             bankdir=bankdir)
         
+        ##Bilinear interpolation between four surrounding PRFs, both of the
+        ##PRF itself and of its reshaped form used for interpolation
         ##Size: 11x11x13x13 
         #indices: subrow index (from bottom), subcol index (from left),
         #TPF row index (from bottom), TPF col index (from left),
-        reshaped = np.zeros((11,11,13,13)) 
-        
-        #Un-interleve PRF samples
-        for i in range(9): #col number
-            for j in range(9): #row number
-                reshaped[i+1,j+1,:,:] = self.prf[8-i::9, 8-j::9] #col, row, cols, rows
-        
-        #Add columns just beyond pixel edges
-        for j in range(1,10): #loop over rows
-            reshaped[j,0,:,:] = np.append(reshaped[j,-2,:,1:],np.zeros((13,1)),axis=1)
-            reshaped[j,-1,:,:] = np.append(np.zeros((13,1)),reshaped[j,1,:,:-1],axis=1)
-        
-        #Add rows just beyond pixel edges
-        for i in range(0,11):
-            reshaped[0,i,:,:] = np.append(reshaped[-2,i,1:,:],np.zeros((1,13)),axis=0)
-            reshaped[-1,i,:,:] = np.append(np.zeros((1,13)),reshaped[1,i,:-1,:],axis=0)
-        
-        #Store for later use
-        self.reshaped = reshaped
+        self.prf, self.reshaped = self.bank.prf(colnum, rownum)
         
     def locate(self, sourcecol, sourcerow, fac, stampsize=(13,13)):
         """Interpolate TESS PRF at location within "interleaved" TPF
@@ -188,6 +128,42 @@ class TESS_PRF:
         
         return tpfmodel
         
+    def envelope(self):
+        """Bound of the PRF vs distance to the source's pixel (see prf_envelope)"""
+        return prf_envelope(self.reshaped)
+        
+    def locate_many(self, sourcecols, sourcerows, facs, stampsize=(13,13), stack=False,
+                    sparse=False):
+        """Interpolate TESS PRF at many locations within a TPF at once
+        
+        Vectorized equivalent of calling `locate` for every source.
+        
+        sourcecols (array): col positions of stars (relative to TPF)
+        sourcerows (array): row positions of stars (relative to TPF)
+        facs (array): flux of each star
+        stampsize (int,int): (height,width) of TPF
+        stack (bool): if True, return an (N,height,width) array with the
+            model of each star; by default return their sum
+        sparse (bool): if True, return the model of each star as the rows of
+            a scipy.sparse CSR matrix of shape (N, height*width)
+        """
+        colint, colfract, rowint, rowfract = split_positions(sourcecols, sourcerows)
+        finite = np.isfinite(colfract) & np.isfinite(rowfract)
+        (rowbelow, rowabove, colbelow, colabove), weights = subpixel_weights(
+            np.where(finite, colfract, 0.5), np.where(finite, rowfract, 0.5))
+        
+        #interpolate
+        subsampled = sum(w[:,None,None] * self.reshaped[r,c]
+                         for w, r, c in zip(weights,
+                                            (rowbelow, rowabove, rowbelow, rowabove),
+                                            (colbelow, colbelow, colabove, colabove)))
+        #re-normalize to 1
+        subsampled /= np.sum(subsampled, axis=(1,2))[:,None,None]
+        subsampled *= np.asarray(facs, dtype=float)[:,None,None]
+        subsampled[~finite] = 0
+        
+        return place_stamps(subsampled, colint, rowint, stampsize, stack=stack, sparse=sparse)
+        
 class Gaussian_PRF:
     """Gaussian Pixel Response Function object
     
@@ -238,6 +214,7 @@ class Gaussian_PRF:
         superrow = (np.arange(stampsize[0]*supersamplefactor) + 0.5) / supersamplefactor
         
         #Interpolate PRF values onto supersampled stamp pixels
+        from scipy.interpolate import RectBivariateSpline
         interppix = RectBivariateSpline(relprfrow,relprfcol,self.prf)
         interped = interppix(superrow,supercol) #Interpolate
         
@@ -259,3 +236,74 @@ class Gaussian_PRF:
                 output += interped[i::supersamplefactor,j::supersamplefactor]
         output /= supersamplefactor**2.
         return output
+        
+    def pixel_fractions(self, centers, npix):
+        """Fraction of a 1D Gaussian falling in each pixel, per source
+        
+        centers (array): source positions along one axis (relative to TPF)
+        npix (int): number of TPF pixels along that axis
+        
+        Returns an (N,npix) array. Pixel j spans [j,j+1], as in `locate`.
+        """
+        from scipy.special import erf
+        edges = np.arange(npix+1)
+        centers = np.asarray(centers, dtype=float)
+        cdf = 0.5*erf((edges[None,:] - centers[:,None]) / (np.sqrt(2)*self.sigma))
+        return np.diff(cdf, axis=1)
+        
+    def envelope(self, maxdistance=None):
+        """Bound of the pixel-integrated PRF vs distance to the source's pixel
+        
+        The k-th element is the largest fraction of the flux that can fall
+        in a pixel at Chebyshev distance k from the pixel of the source
+        (see prf_envelope), up to maxdistance pixels. By default, maxdistance
+        spans 8 sigma, beyond which the Gaussian tail (< 1e-15) is zero in
+        double precision, so that cull_sources never drops a source that
+        still contributes flux.
+        """
+        from scipy.special import erf
+        if maxdistance is None:
+            maxdistance = int(np.ceil(8*self.sigma)) + 1
+        k = np.arange(1, maxdistance+1)
+        scale = np.sqrt(2)*self.sigma
+        central = erf(0.5/scale) #source at the pixel center
+        #source at the pixel edge closest to the pixel at distance k
+        tail = 0.5*(erf(k/scale) - erf((k-1)/scale))
+        return np.append(central, tail) * central
+        
+    def locate_many(self, sourcecols, sourcerows, facs, stampsize=(13,13), stack=False,
+                    sparse=False):
+        """Pixel-integrated Gaussian PRF of many sources within a TPF
+        
+        The pixel-integrated Gaussian is separable, so each stamp is computed
+        exactly as the outer product of erf differences along rows and
+        columns, with no supersampling or interpolation. Unlike `locate`,
+        stamps are not re-normalized over the TPF: each pixel gets the
+        fraction of `fac` that truly falls in it, so sources near or beyond
+        the edges only contribute their tails.
+        
+        sourcecols (array): col positions of stars (relative to TPF)
+        sourcerows (array): row positions of stars (relative to TPF)
+        facs (array): flux of each star
+        stampsize (int,int): (height,width) of TPF
+        stack (bool): if True, return an (N,height,width) array with the
+            model of each star; by default return their sum
+        sparse (bool): if True, return the model of each star as the rows of
+            a scipy.sparse CSR matrix of shape (N, height*width)
+        """
+        facs = np.asarray(facs, dtype=float)
+        rowfractions = np.nan_to_num(self.pixel_fractions(sourcerows, stampsize[0]))
+        colfractions = np.nan_to_num(self.pixel_fractions(sourcecols, stampsize[1]))
+        if sparse:
+            #only pixels where both fractions are non-zero (erf saturates a
+            #few sigma away from the source)
+            sources, tpfrows, tpfcols = np.nonzero((rowfractions > 0)[:,:,None] &
+                                                   (colfractions > 0)[:,None,:])
+            values = (facs[sources] * rowfractions[sources, tpfrows] *
+                      colfractions[sources, tpfcols])
+            from scipy.sparse import csr_matrix
+            return csr_matrix((values, (sources, tpfrows*stampsize[1] + tpfcols)),
+                              shape=(len(facs), stampsize[0]*stampsize[1]))
+        if stack:
+            return facs[:,None,None] * rowfractions[:,:,None] * colfractions[:,None,:]
+        return (rowfractions * facs[:,None]).T @ colfractions
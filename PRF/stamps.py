@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized helpers to interpolate the reshaped (11x11x13x13) TESS PRF models
+at sub-pixel positions and place the resulting 13x13 stamps within a TPF,
+for many sources at once. Used by TESS_PRF.locate_many and
+PRFBank.locate_many. cull_sources discards up front the sources that cannot
+contribute significantly to any TPF pixel.
+"""
+import numpy as np
+
+def split_positions(sourcecols, sourcerows):
+    """Break source positions into integer and fractional pixels
+    
+    Pixel positions follow the convention that integers refer to the pixel
+    center. Returns (colint, colfract, rowint, rowfract) arrays.
+    """
+    #adding 0.5 to conform to convention
+    sourcecols = np.asarray(sourcecols, dtype=float) + 0.5
+    sourcerows = np.asarray(sourcerows, dtype=float) + 0.5
+    return (np.floor(sourcecols), sourcecols % 1,
+            np.floor(sourcerows), sourcerows % 1)
+
+def subpixel_weights(colfract, rowfract):
+    """Four surrounding subpixel PRF models and their bilinear weights
+    
+    colfract, rowfract (arrays): fractional pixel positions, in [0,1)
+    
+    Returns (rowbelow, rowabove, colbelow, colabove), the indices into the
+    first two axes of the 11x11x13x13 reshaped PRF, and the weights of the
+    (rowbelow,colbelow), (rowabove,colbelow), (rowbelow,colabove) and
+    (rowabove,colabove) models, in that order.
+    """
+    #Sub-pixel sample locations (in each dirextion, w/ border added)
+    pixelsamples = np.arange(-1/18,19.1/18,1/9)
+    
+    #first sample >= fract, and the one just below it
+    colabove = np.clip(np.searchsorted(pixelsamples, colfract), 1, 10)
+    rowabove = np.clip(np.searchsorted(pixelsamples, rowfract), 1, 10)
+    colbelow, rowbelow = colabove - 1, rowabove - 1
+    
+    x1, x2 = pixelsamples[colbelow], pixelsamples[colabove]
+    y1, y2 = pixelsamples[rowbelow], pixelsamples[rowabove]
+    norm = (x2 - x1) * (y2 - y1)
+    weights = ((x2 - colfract) * (y2 - rowfract) / norm,
+               (x2 - colfract) * (rowfract - y1) / norm,
+               (colfract - x1) * (y2 - rowfract) / norm,
+               (colfract - x1) * (rowfract - y1) / norm)
+    return (rowbelow, rowabove, colbelow, colabove), weights
+
+def place_stamps(stamps, colint, rowint, stampsize=(13,13), stack=False, sparse=False):
+    """Place 13x13 PRF stamps at integer pixel locations within a TPF
+    
+    stamps (array): (N,13,13) PRF models, centred on their pixel (6,6)
+    colint, rowint (arrays): TPF pixel where each stamp center falls
+    stampsize (int,int): (height,width) of TPF
+    stack (bool): return the (N,height,width) models of each source instead
+        of their sum
+    sparse (bool): return the models of each source as a scipy.sparse CSR
+        matrix of shape (N, height*width) (sources x flattened TPF pixels),
+        whose memory scales with the PRF footprints rather than the TPF area
+    
+    Parts of the stamps falling outside the TPF are dropped, as are sources
+    with non-finite positions.
+    """
+    #PRF models are 13x13 pixels
+    #center of PRF is pixel (6,6)
+    midprf = 6
+    nsources = len(stamps)
+    offsets = np.arange(-midprf, midprf+1)
+    
+    shape = (nsources, 2*midprf+1, 2*midprf+1)
+    tpfrows = np.broadcast_to(np.asarray(rowint)[:,None,None] + offsets[:,None], shape)
+    tpfcols = np.broadcast_to(np.asarray(colint)[:,None,None] + offsets[None,:], shape)
+    with np.errstate(invalid='ignore'):
+        inside = ((tpfrows >= 0) & (tpfrows < stampsize[0]) &
+                  (tpfcols >= 0) & (tpfcols < stampsize[1]))
+    pixels = (tpfrows[inside] * stampsize[1] + tpfcols[inside]).astype(int)
+    
+    if sparse:
+        sources = np.broadcast_to(np.arange(nsources)[:,None,None], stamps.shape)[inside]
+        from scipy.sparse import csr_matrix
+        return csr_matrix((stamps[inside], (sources, pixels)),
+                          shape=(nsources, stampsize[0]*stampsize[1]))
+    
+    if stack:
+        sources = np.broadcast_to(np.arange(nsources)[:,None,None], stamps.shape)[inside]
+        tpfmodels = np.zeros((nsources, stampsize[0]*stampsize[1]))
+        tpfmodels[sources, pixels] = stamps[inside]
+        return tpfmodels.reshape((nsources,) + tuple(stampsize))
+    
+    tpfmodel = np.bincount(pixels, weights=stamps[inside],
+                           minlength=stampsize[0]*stampsize[1])
+    return tpfmodel.reshape(stampsize)
+
+def prf_envelope(reshaped):
+    """Upper bound of the fraction of a source's flux falling in one pixel,
+    as a function of the distance to the source's pixel
+    
+    reshaped (array): (..., 11, 11, 13, 13) reshaped PRF models
+    
+    Returns an array whose k-th element bounds the (normalized) PRF at
+    Chebyshev distance k (in pixels) from the pixel of the source; PRFs
+    are zero beyond its last element. Since interpolated models are convex
+    combinations of the sub-pixel models, and are re-normalized to 1, the
+    bound is the largest value at each distance over the smallest sum.
+    """
+    reshaped = np.asarray(reshaped)
+    models = reshaped.reshape((-1, 13, 13))
+    midprf = 6
+    offsets = np.abs(np.arange(-midprf, midprf+1))
+    distance = np.maximum(offsets[:,None], offsets[None,:])
+    norm = np.min(np.sum(models, axis=(1,2)))
+    return np.array([np.max(models[:, distance == k]) for k in range(midprf+1)]) / norm
+
+def cull_sources(sourcecols, sourcerows, facs, stampsize, envelope, tolerance=0.,
+                 mask=None):
+    """Select the sources that can contribute to a TPF
+    
+    A KD-tree over the TPF pixels gives the (Chebyshev) distance from the
+    pixel of each source to the closest TPF pixel, which bounds its
+    contribution to any pixel as fac*envelope[distance].
+    
+    sourcecols, sourcerows (arrays): positions of the stars (relative to TPF)
+    facs (array): flux of each star
+    stampsize (int,int): (height,width) of TPF
+    envelope (array): bound of the PRF vs distance (see prf_envelope)
+    tolerance (float): skip sources contributing at most this flux to
+        every pixel (default 0: only skip sources that cannot reach the TPF)
+    mask (bool array, default None): only consider these TPF pixels
+    
+    Returns (keep, neglected): boolean array of the sources to keep, and an
+    upper bound of the flux added to any single pixel by the skipped ones.
+    """
+    colint, _, rowint, _ = split_positions(sourcecols, sourcerows)
+    facs = np.abs(np.asarray(facs, dtype=float))
+    if mask is None:
+        mask = np.ones(stampsize, dtype=bool)
+    from scipy.spatial import cKDTree
+    tree = cKDTree(np.argwhere(mask))
+    
+    finite = np.isfinite(colint) & np.isfinite(rowint)
+    distance = np.full(len(facs), np.inf)
+    distance[finite], _ = tree.query(np.stack([rowint[finite], colint[finite]], axis=1),
+                                     p=np.inf, distance_upper_bound=len(envelope))
+    
+    bound = np.zeros(len(facs))
+    reach = distance < len(envelope)
+    bound[reach] = facs[reach] * envelope[distance[reach].astype(int)]
+    keep = bound > tolerance
+    return keep, np.sum(bound[~keep])
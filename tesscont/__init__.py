@@ -0,0 +1,8 @@
+from .gaia import GaiaCache, query_gaia
+from .tic import TICGaiaMap, get_gaia_id, resolve_gaia_ids, crossmatch_gaia
+from .sectors import run_sectors
+from .contamination import compute_contamination, ContaminationResult, load_result
+from .aperture import optimize_aperture, ApertureOptimization
+from .render import Renderer, render_figures, save_figures, active_renderer
+from .metrics import MetricsStore, save_metrics, deferred_export
+from .hdf5 import write_hdf5
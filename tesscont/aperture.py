@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Aperture optimization from the per-pixel fluxes of a ContaminationResult.
+
+Once the PRFs of all the sources are placed, the flux of the target (t) and
+of all the sources (f) in each pixel are known, and the metrics of any
+aperture A are sums over its pixels:
+
+    FLFRCSAP = T = sum_A t,    CROWDSAP = T / F,  with F = sum_A f
+
+optimize_aperture searches the apertures that maximize an objective of
+(T, F, number of pixels), updating the three sums as pixels are added
+rather than recomputing them:
+ - greedy: starting from the pixel with the most target flux, adds at each
+   step the neighbouring pixel (sharing a side with the aperture) that
+   gives the highest objective, until the whole TPF is covered
+ - threshold_target_flux: the apertures `CROWDSAP_pixel_by_pixel > threshold`
+   (as `aperture: threshold_target_flux`) for every threshold, i.e. the
+   pixels sorted by the flux ratio of the target, and accumulated
+The objectives are
+ - crowdsap_flfrcsap: CROWDSAP x FLFRCSAP = T^2 / F
+ - snr: signal-to-noise ratio of the target flux, with photon noise from all
+   the sources and a noise per pixel (e.g. background and read noise):
+   N T / sqrt(N F + n pixel_noise^2), for a target giving N counts
+   (without pixel noise, this is sqrt(N T^2 / F), so both objectives then
+   select the same aperture)
+or any function objective(T, F, n) of numpy arrays.
+"""
+import numpy as np
+
+OBJECTIVES = ['crowdsap_flfrcsap', 'snr']
+METHODS = ['greedy', 'threshold_target_flux', 'all']
+
+def _objective(objective, target_counts=1e6, pixel_noise=0.):
+    if callable(objective):
+        return objective
+    if objective == 'crowdsap_flfrcsap':
+        return lambda T, F, n: T**2 / F
+    if objective == 'snr':
+        return lambda T, F, n: target_counts*T / np.sqrt(target_counts*F + n*pixel_noise**2)
+    raise ValueError(f'Unknown aperture objective: {objective} (options: {", ".join(OBJECTIVES)})')
+
+class ApertureOptimization:
+    """Optimal aperture and trade-off curve of an aperture search
+
+    attributes:
+     - mask (boolean array): optimal aperture
+     - CROWDSAP, FLFRCSAP (float): metrics of the optimal aperture
+     - objective (float): objective of the optimal aperture
+     - method (str): search that found it ('greedy' or 'threshold_target_flux')
+     - curve (pandas DataFrame): every aperture visited by the search(es),
+       in order, with columns method, n_pixels, pixel (flat index of the
+       last pixel added), threshold (threshold_target_flux only),
+       CROWDSAP, FLFRCSAP and objective
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return (f'<ApertureOptimization ({self.method}): {int(self.mask.sum())} pixels, '
+                f'CROWDSAP = {self.CROWDSAP:.4f}, FLFRCSAP = {self.FLFRCSAP:.4f}>')
+
+def _greedy(t, f, score, max_pixels):
+    ny, nx = t.shape
+    t, f = t.ravel(), f.ravel()
+    seen = np.zeros(t.size, dtype=bool)
+    candidates = np.empty(0, dtype=int)
+    order, T, F = [], [], []
+    pixel = int(np.argmax(t))
+    seen[pixel] = True
+    T_A = F_A = 0.
+    for n in range(1, max_pixels+1):
+        T_A, F_A = T_A + t[pixel], F_A + f[pixel]
+        order.append(pixel)
+        T.append(T_A)
+        F.append(F_A)
+        #the neighbours (sharing a side) of the new pixel become candidates
+        i, j = divmod(pixel, nx)
+        new = [ii*nx + jj for ii, jj in [(i-1, j), (i+1, j), (i, j-1), (i, j+1)]
+               if 0 <= ii < ny and 0 <= jj < nx and not seen[ii*nx + jj]]
+        if new:
+            seen[new] = True
+            candidates = np.concatenate([candidates, new])
+        if len(candidates) == 0:
+            break
+        #objective of every candidate aperture, from the running sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = score(T_A + t[candidates], F_A + f[candidates], n + 1)
+        k = int(np.argmax(np.where(np.isnan(scores), -np.inf, scores)))
+        pixel = int(candidates[k])
+        candidates = np.delete(candidates, k)
+    return np.array(order), np.array(T), np.array(F), np.full(len(order), np.nan)
+
+def _threshold_sweep(t, f, ratio, max_pixels):
+    order = np.argsort(-ratio.ravel(), kind='stable')[:max_pixels]
+    return order, np.cumsum(t.ravel()[order]), np.cumsum(f.ravel()[order]), ratio.ravel()[order]
+
+def optimize_aperture(target_flux, total_flux, objective='crowdsap_flfrcsap', method='greedy',
+                      target_counts=1e6, pixel_noise=0., max_pixels=None):
+    """Aperture maximizing an objective of the target and total fluxes inside it
+
+    inputs:
+     - target_flux (array, ny x nx): flux of the target in each pixel, in
+       units of its total flux (ContaminationResult.resampled_target)
+     - total_flux (array, ny x nx): flux of all the sources in each pixel
+       (ContaminationResult.resampled)
+     - objective (str or function, default 'crowdsap_flfrcsap'):
+       'crowdsap_flfrcsap', 'snr', or a function objective(T, F, n)
+     - method (str, default 'greedy'): 'greedy', 'threshold_target_flux', or
+       'all' (the best aperture of both searches)
+     - target_counts (float, default 1e6): counts of the target (snr only)
+     - pixel_noise (float, default 0): noise per pixel, in counts (snr only)
+     - max_pixels (int, default None): largest aperture considered
+
+    returns an ApertureOptimization
+    """
+    import pandas as pd
+    if method not in METHODS:
+        raise ValueError(f'Unknown aperture optimization method: {method} (options: {", ".join(METHODS)})')
+    score = _objective(objective, target_counts=target_counts, pixel_noise=pixel_noise)
+    t = np.nan_to_num(np.asarray(target_flux, dtype=float))
+    f = np.nan_to_num(np.asarray(total_flux, dtype=float))
+    max_pixels = t.size if max_pixels is None else max(min(int(max_pixels), t.size), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(f > 0, t / f, 0.)
+
+    curves, best = [], None
+    for name in (['greedy', 'threshold_target_flux'] if method == 'all' else [method]):
+        if name == 'greedy':
+            order, T, F, thresholds = _greedy(t, f, score, max_pixels)
+        else:
+            order, T, F, thresholds = _threshold_sweep(t, f, ratio, max_pixels)
+        n = np.arange(1, len(order)+1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.asarray(score(T, F, n), dtype=float)
+            crowdsap = T / F
+        curves.append(pd.DataFrame({'method': name, 'n_pixels': n, 'pixel': order, 'threshold': thresholds,
+                                    'CROWDSAP': crowdsap, 'FLFRCSAP': T, 'objective': scores}))
+        k = int(np.nanargmax(scores)) if np.any(np.isfinite(scores)) else 0
+        if best is None or scores[k] > best[0]:
+            best = (scores[k], name, order[:k+1], crowdsap[k], T[k])
+
+    objective_value, name, pixels, crowdsap, flfrcsap = best
+    mask = np.zeros(t.size, dtype=bool)
+    mask[pixels] = True
+    return ApertureOptimization(mask=mask.reshape(t.shape), CROWDSAP=float(crowdsap), FLFRCSAP=float(flfrcsap),
+                                objective=float(objective_value), method=name,
+                                curve=pd.concat(curves, ignore_index=True))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch runner: process many TESS-cont configurations in a single process.
+
+    python -m tesscont.batch CONFIGS [--template BASE.ini] [--summary FILE.csv]
+
+CONFIGS is either a directory of .ini files, or a CSV manifest with one
+target per row. Manifest columns are configuration keys: `target` goes to
+the MANDATORY section, `SECTION.key` columns (e.g. `APERTURE.aperture`) to
+that section, and any other column (e.g. `sector`, `target_name`) to the
+OPTIONAL section; keys not given are taken from the --template file. The
+configuration of each row is written to --configdir before running it.
+
+Every configuration is run through TESS-cont.py in this same interpreter,
+so lightkurve/astropy/matplotlib are imported once, and the PRF banks
+loaded by one target (see PRF/bank.py) are reused by the next ones, along
+with the local Gaia and TIC caches. The Gaia IDs of all TIC targets are
+resolved with a single MAST query before starting. A target that fails
+(with an exception, or by calling sys.exit) does not stop the batch: the
+error is recorded, and a summary of all targets is printed at the end.
+
+Run it from the TESS-cont directory (output/ and metrics.dat are written
+relative to the current directory, as for TESS-cont.py).
+"""
+import os
+import re
+import sys
+import csv
+import time
+import runpy
+import argparse
+import traceback
+from glob import glob
+from configparser import ConfigParser
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TESS-cont.py')
+
+def use_agg():
+    """Non-interactive matplotlib backend (without importing matplotlib if it is not imported yet)"""
+    os.environ['MPLBACKEND'] = 'Agg'
+    if 'matplotlib' in sys.modules:
+        sys.modules['matplotlib'].use('Agg')
+
+class _LastLine:
+    #stream that echoes to stdout, remembering the last printed line
+    #(TESS-cont.py prints the reason before calling sys.exit)
+    def __init__(self, stream):
+        self.stream, self.line = stream, ''
+    def write(self, text):
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if len(lines) > 0:
+            self.line = lines[-1]
+        return self.stream.write(text)
+    def flush(self):
+        self.stream.flush()
+
+def manifest_configs(manifest, configdir, template=None):
+    """Write one configuration file per row of a CSV manifest
+
+    inputs:
+     - manifest (str): CSV file, with a `target` column (see module docstring)
+     - configdir (str): directory for the generated configuration files
+     - template (str, default None): configuration file with the default values
+
+    returns the paths of the configuration files
+    """
+    os.makedirs(configdir, exist_ok=True)
+    paths = []
+    with open(manifest, newline='') as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            config = ConfigParser()
+            if template is not None:
+                config.read(template)
+            for section in ['MANDATORY', 'OPTIONAL']:
+                if not config.has_section(section):
+                    config.add_section(section)
+            for key, value in row.items():
+                if key is None or value is None or value.strip() == '':
+                    continue
+                key, value = key.strip(), value.strip()
+                if key == 'target':
+                    section = 'MANDATORY'
+                elif '.' in key:
+                    section, key = key.split('.', 1)
+                else:
+                    section = 'OPTIONAL'
+                if not config.has_section(section):
+                    config.add_section(section)
+                config[section][key] = value
+            name = config['OPTIONAL'].get('target_name', config['MANDATORY']['target'])
+            sector = config['OPTIONAL'].get('sector', '')
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', f'{i:04d}_{name}_S{sector}')
+            path = os.path.join(configdir, name + '.ini')
+            with open(path, 'w') as out:
+                config.write(out)
+            paths.append(path)
+    return paths
+
+def prefetch_tics(paths):
+    """Resolve the Gaia IDs of all 'TIC ...' targets with one MAST query"""
+    from .tic import resolve_gaia_ids
+    tics = []
+    for path in paths:
+        config = ConfigParser()
+        config.read(path)
+        match = re.match(r'^TIC\s*(\d+)$', config['MANDATORY'].get('target', '').strip())
+        if match:
+            tics.append(match.group(1))
+    if len(tics) > 0:
+        try:
+            resolve_gaia_ids(sorted(set(tics)))
+        except Exception as e:
+            print(f'The Gaia IDs of the TIC targets could not be pre-fetched ({e})')
+
+def run_config(path, script=SCRIPT):
+    """Run TESS-cont.py on one configuration file in this process
+
+    returns (status, message, seconds): status is 'ok' or 'failed'
+    """
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = [script, path]
+    sys.stdout = _LastLine(stdout)
+    start = time.time()
+    try:
+        runpy.run_path(script, run_name='__main__')
+        status, message = 'ok', ''
+    except SystemExit as e:
+        #TESS-cont.py exits early (without a code) when a target cannot be
+        #processed, and with code 0 after a multi-sector run
+        if e.code == 0:
+            status, message = 'ok', ''
+        else:
+            message = sys.stdout.line if e.code is None else str(e.code)
+            status, message = 'failed', message or 'exited'
+    except Exception as e:
+        traceback.print_exc()
+        status, message = 'failed', f'{type(e).__name__}: {e}'
+    finally:
+        sys.argv, sys.stdout = argv, stdout
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+    return status, message, time.time() - start
+
+def run_batch(configs, template=None, configdir=os.path.join('output', 'batch_configs'),
+              summary=None, render_workers=1, max_pending=4, script=SCRIPT):
+    """Run TESS-cont.py on a directory of configuration files or a CSV manifest
+
+    The figures of each target are drawn by render_workers background
+    processes (see tesscont/render.py) while the next targets are processed,
+    with at most max_pending targets waiting for their figures; with
+    render_workers=0, each run draws its own figures.
+
+    returns a list of (configuration file, status, message, seconds)
+    """
+    if os.path.isdir(configs):
+        paths = sorted(glob(os.path.join(configs, '*.ini')))
+    else:
+        paths = manifest_configs(configs, configdir, template=template)
+    #the script cannot show figures in a batch
+    use_agg()
+    prefetch_tics(paths)
+
+    from .render import Renderer
+    from .metrics import deferred_export
+    results = []
+    #metrics.dat is exported from the metrics store once, at the end
+    with Renderer(render_workers, max_pending) as renderer, deferred_export():
+        for i, path in enumerate(paths):
+            print(f'[{i+1}/{len(paths)}] {path}')
+            results.append((path,) + run_config(path, script=script))
+        if render_workers > 0:
+            print('Waiting for the figures ...')
+
+    failed = [result for result in results if result[1] != 'ok']
+    print(f'\n{len(results) - len(failed)} of {len(results)} configurations processed')
+    for path, status, message, seconds in failed:
+        print(f'  FAILED {path}: {message}')
+    for basename, message in renderer.failed:
+        print(f'  FAILED figures of {basename}: {message}')
+    if summary is not None:
+        with open(summary, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['config', 'status', 'message', 'seconds'])
+            writer.writerows(results)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m tesscont.batch',
+                                     description='Run TESS-cont on many configurations in one process.')
+    parser.add_argument('configs', help='directory of .ini files, or CSV manifest of targets')
+    parser.add_argument('--template', default=None,
+                        help='configuration file with the default values for a CSV manifest')
+    parser.add_argument('--configdir', default=os.path.join('output', 'batch_configs'),
+                        help='where the configuration files of a CSV manifest are written')
+    parser.add_argument('--summary', default=None, help='CSV file with the status of each configuration')
+    parser.add_argument('--render_workers', type=int, default=1,
+                        help='background processes drawing the figures (0: each run draws its own)')
+    parser.add_argument('--max_pending', type=int, default=4,
+                        help='maximum number of targets waiting for their figures')
+    parser.add_argument('--script', default=SCRIPT, help='TESS-cont.py script to run')
+    args = parser.parse_args()
+    results = run_batch(args.configs, template=args.template, configdir=args.configdir,
+                        summary=args.summary, render_workers=args.render_workers,
+                        max_pending=args.max_pending, script=args.script)
+    sys.exit(int(any(result[1] != 'ok' for result in results)))
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Library API of the TESS-cont contamination pipeline.
+
+compute_contamination takes an already downloaded TPF (or tesscut) and the
+Gaia sources around it, and returns a ContaminationResult with the
+contamination metrics (CROWDSAP, FLFRCSAP), the per-pixel flux ratio of the
+target, and the per-source contributions to every pixel and to the
+aperture. It does not download the TPF, plot, or write any file, so it can
+be called repeatedly from a long-running process:
+
+    import lightkurve as lk
+    import tesscont
+    tpf = lk.search_targetpixelfile('TIC 282485660', sector=65).download()
+    gaia_table = tesscont.query_gaia(tpf.ra, tpf.dec, 200.)
+    result = tesscont.compute_contamination(tpf, gaia_table, aperture='pipeline')
+    result.CROWDSAP, result.FLFRCSAP
+
+TESS-cont.py is a thin wrapper around it, adding the downloads, plots and
+output files. Errors that prevent computing the metrics (no target in the
+Gaia table, a target without G magnitude, no pipeline aperture) raise
+ValueError.
+"""
+import re
+import warnings
+import numpy as np
+from .aperture import optimize_aperture
+
+def _tic_number(tic):
+    #TIC number from e.g. 282485660, '282485660', 'TIC 282485660'; None otherwise
+    match = re.match(r'^(TIC)?\s*(\d+)$', str(tic).strip())
+    return match.group(2) if match else None
+
+def identify_target(table, tpf, catalog='DR3', tic=None, tic_crossmatch='mast', cache=True, verbose=True):
+    """Index of the target in the Gaia table
+
+    With tic_crossmatch='mast', the target is the source with the TIC's Gaia
+    ID (see tesscont/tic.py); otherwise, or if that fails, it is the source
+    closest to the (J2000) TIC position of the TPF.
+
+    inputs:
+     - table (astropy Table): Gaia sources
+     - tpf (lightkurve TargetPixelFile): TPF or tesscut of the target
+     - catalog (str, default 'DR3'): Gaia data release of the table
+     - tic (int or str, default None): TIC ID of the target (default: tpf.targetid)
+     - tic_crossmatch (str, default 'mast'): 'mast' or 'positional'
+     - cache (bool, default True): use the local TIC-Gaia map
+    """
+    from .tic import get_gaia_id, crossmatch_gaia
+    tic = _tic_number(tpf.targetid if tic is None else tic)
+    if tic_crossmatch == 'mast' and tic is not None:
+        try:
+            gaia_id = get_gaia_id(tic, cache=cache)
+            if np.any(table['Source'] == gaia_id):
+                return int(np.where(table['Source'] == gaia_id)[0][0])
+        except Exception as e:
+            if verbose:
+                print(f'The Gaia ID of TIC {tic} could not be obtained from MAST ({e})')
+    idx_target = crossmatch_gaia(table, tpf.ra, tpf.dec, catalog=catalog)
+    if idx_target is None:
+        raise ValueError(f'There is no Gaia {catalog} source at the position of the target')
+    if verbose:
+        print(f'Target cross-matched by position with Gaia {catalog} {table["Source"][idx_target]}')
+    return idx_target
+
+def propagate_to_pixels(table, tpf, catalog='DR3', pm_propagation='linear'):
+    """Gaia positions propagated to the TPF epoch, and their TPF pixel coordinates
+
+    inputs:
+     - table (astropy Table): Gaia sources
+     - tpf (lightkurve TargetPixelFile): TPF or tesscut
+     - catalog (str, default 'DR3'): Gaia data release of the table
+     - pm_propagation (str, default 'linear'): 'linear' (RA/Dec offsets) or
+       'space_motion' (astropy, also using the parallaxes)
+
+    returns (coords, pixel_coords): SkyCoord array, and (N,2) array with the
+    (column, row) of each source relative to the TPF
+    """
+    from astropy import wcs
+    from astropy import units as u
+    from astropy.time import Time
+    from astropy.coordinates import SkyCoord, Distance
+
+    if catalog == 'DR3':
+        t_reference =  2457389            # 2016-01-01 12:00:00.000 | Lindegren et al. (2021)
+    if catalog == 'DR2':
+        t_reference = 2457389 - 182.625   # 2015-07-02 21:00:00.000 | Lindegren et al. (2021)
+    t_inc = (tpf.time[0].jd - t_reference) / 365  #year
+
+    #the whole catalog is propagated and converted at once (one SkyCoord array and one wcs transformation)
+    pmra = np.nan_to_num(np.ma.filled(table['pmRA'].value, 0.))  #mas/yr (sources without pm are not moved)
+    pmde = np.nan_to_num(np.ma.filled(table['pmDE'].value, 0.))
+
+    if pm_propagation == 'space_motion':
+        #full space motion propagation, using the parallaxes (and radial velocities) when available
+        plx = np.nan_to_num(np.ma.filled(table['Plx'].value, 0.)) if 'Plx' in table.colnames else np.zeros(len(table))
+        rv = np.nan_to_num(np.ma.filled(table['RV'].value, 0.)) if 'RV' in table.colnames else np.zeros(len(table))
+        plx[plx <= 0] = 1e-3  #mas. Sources without (a positive) parallax are placed at 1 Mpc
+        coords = SkyCoord(ra = np.ma.filled(table['RA_ICRS'].value, np.nan) * u.deg,
+                          dec = np.ma.filled(table['DE_ICRS'].value, np.nan) * u.deg,
+                          pm_ra_cosdec = pmra * u.mas / u.yr, pm_dec = pmde * u.mas / u.yr,
+                          distance = Distance(parallax = plx * u.mas), radial_velocity = rv * u.km / u.s,
+                          obstime = Time(t_reference, format = 'jd'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  #ERFA warns about the sources placed at 1 Mpc
+            coords = coords.apply_space_motion(new_obstime = Time(tpf.time[0].jd, format = 'jd'))
+    else:
+        coords = SkyCoord(np.ma.filled(table['RA_ICRS'].value, np.nan) + pmra / 3600000 * t_inc,
+                          np.ma.filled(table['DE_ICRS'].value, np.nan) + pmde / 3600000 * t_inc,
+                          unit = "deg")  # defaults to ICRS frame | includes pm correction
+
+    pixel_coords = np.array(wcs.utils.skycoord_to_pixel(coords, tpf.wcs, origin = 0, mode='all'), dtype = float).T
+    return coords, pixel_coords
+
+def build_contributions(tpf, pixel_coords, flux, idx_target, method_prf='accurate', gaussian_sigma=1.,
+                        flux_tolerance=0., prf_bankdir=None, n_workers=1, verbose=True):
+    """Flux of every source in every TPF pixel
+
+    inputs:
+     - tpf (lightkurve TargetPixelFile): TPF or tesscut
+     - pixel_coords (array): (N,2) pixel coordinates of the sources (see propagate_to_pixels)
+     - flux (array): flux of each source, relative to the target
+     - idx_target (int): index of the target
+     - method_prf (str, default 'accurate'): 'accurate' (the PRF of each
+       source's own pixel), 'approximate' (the PRF of the middle of the TPF
+       for all sources), or 'gaussian'
+     - gaussian_sigma (float, default 1): sigma of the Gaussian PRF [pixels]
+     - flux_tolerance (float, default 0): sources contributing less than this
+       (relative to the target) to every pixel are skipped
+     - prf_bankdir (str, default None): directory with compiled PRF banks
+     - n_workers (int, default 1): worker processes to place the PRFs
+
+    returns (contributions, idxs_keep, neglected_flux): a sparse CSR matrix
+    (sources x TPF pixels), with empty rows for the skipped sources; the
+    indices of the sources kept; and a bound of the flux skipped per pixel
+    """
+    import PRF
+    from scipy.sparse import csr_matrix
+    cam, ccd, sector = tpf.camera, tpf.ccd, tpf.sector
+    pixel_coords = np.asarray(pixel_coords, dtype = float)
+    flux = np.asarray(flux, dtype = float)
+
+    if method_prf == 'approximate':
+        #the PRF is estimated in the middle of the TPF ONLY ONCE, and used for all targets
+        #(assuming that its shape won't change much)
+        prf = PRF.TESS_PRF(cam, ccd, sector, tpf.column+tpf.shape[2]/2, tpf.row+tpf.shape[1]/2,
+                           bankdir = prf_bankdir)
+        if verbose:
+            print('PRF built in the middle of the TPF (approximate method)')
+    elif method_prf == 'gaussian':
+        #the PRF is approximated by a Gaussian, integrated analytically over each pixel
+        prf = PRF.Gaussian_PRF(sigma = gaussian_sigma)
+        if verbose:
+            print(f'Gaussian PRF with sigma = {gaussian_sigma} pixels (gaussian method)')
+    elif method_prf == 'accurate':
+        #the PRF of each source is interpolated at its own pixel. The PRF grid of the camera/CCD is
+        #loaded only once, and the sources falling in the same pixel share the same interpolation
+        #weights between the surrounding grid PRFs
+        prf = PRF.get_bank(cam, ccd, sector, bankdir = prf_bankdir)
+        colnums = np.trunc(tpf.column + pixel_coords[:,0])
+        rownums = np.trunc(tpf.row + pixel_coords[:,1])
+    else:
+        raise ValueError(f'Unknown method_prf: {method_prf}')
+
+    #sources that cannot contribute more than 'flux_tolerance' to any pixel of the tpf are skipped,
+    #as well as those too far away from the tpf (their PRF would be empty anyway)
+    keep, neglected_flux = PRF.cull_sources(pixel_coords[:,0], pixel_coords[:,1], flux,
+                                            tpf.shape[1:3], prf.envelope(), tolerance = flux_tolerance)
+    keep[idx_target] = True
+    idxs_keep = np.where(keep)[0]
+    if verbose:
+        print(f'{len(idxs_keep)} of the {len(flux)} Gaia sources can contribute to the tpf. The skipped ones add '
+              f'less than {"{:.2e}".format(neglected_flux)} times the target flux to any pixel')
+
+    #the PRF is located in each star's location (all stars at once, split over n_workers processes)
+    if method_prf == 'approximate':
+        arrays = (pixel_coords[idxs_keep,0], pixel_coords[idxs_keep,1], flux[idxs_keep])
+    if method_prf == 'gaussian':
+        #the Gaussian PRF has the pixel edges at integer positions, while the tpf has the pixel centers
+        arrays = (pixel_coords[idxs_keep,0]+0.5, pixel_coords[idxs_keep,1]+0.5, flux[idxs_keep])
+    if method_prf == 'accurate':
+        arrays = (colnums[idxs_keep], rownums[idxs_keep],
+                  pixel_coords[idxs_keep,0], pixel_coords[idxs_keep,1], flux[idxs_keep])
+    contributions_keep = PRF.locate_parallel(prf, arrays, tpf.shape[1:3], n_workers = n_workers).tocoo()
+
+    #one row per source (empty rows for the skipped sources)
+    contributions = csr_matrix((contributions_keep.data, (idxs_keep[contributions_keep.row], contributions_keep.col)),
+                               shape = (len(flux), contributions_keep.shape[1]))
+    return contributions, idxs_keep, neglected_flux
+
+def select_aperture(tpf, aperture, CROWDSAP_pixel_by_pixel, threshold_target=0.7, threshold_median=3):
+    """Photometric aperture mask
+
+    inputs:
+     - tpf (lightkurve TargetPixelFile): TPF or tesscut
+     - aperture (str or boolean array): 'pipeline' (SPOC aperture),
+       'threshold_target_flux' (pixels where the target contributes more than
+       threshold_target of the flux), 'threshold_median_flux' (pixels
+       threshold_median sigmas above the median tpf flux), or a mask
+     - CROWDSAP_pixel_by_pixel (array): flux ratio of the target in each pixel
+    """
+    if not isinstance(aperture, str):
+        aperture_mask = np.asarray(aperture, dtype = bool)
+        if aperture_mask.shape != tuple(tpf.shape[1:3]):
+            raise ValueError(f'The aperture mask has shape {aperture_mask.shape}, and the tpf {tuple(tpf.shape[1:3])}')
+        return aperture_mask
+    if aperture == 'pipeline':
+        aperture_mask = tpf.pipeline_mask
+        if len(np.where(aperture_mask==True)[0]) == 0:
+            raise ValueError(f'The target TIC {tpf.targetid} does not have a pipeline aperture in sector {tpf.sector}. '
+                             'Please modify your config.ini file so that **aperture: threshold_target_flux** or '
+                             '**aperture: threshold_median_flux** in order to create your own aperture (see the '
+                             'documentaion for details on each aperture creation method).')
+        return aperture_mask
+    if aperture == 'threshold_median_flux':
+        return tpf.create_threshold_mask(threshold=threshold_median)
+    if aperture == 'threshold_target_flux':
+        return CROWDSAP_pixel_by_pixel > threshold_target
+    raise ValueError(f'Unknown aperture: {aperture}')
+
+def rank_contaminants(CROWDSAP_arr, CROWDSAP, n_sources=5):
+    """Most contaminant sources inside the aperture
+
+    inputs:
+     - CROWDSAP_arr (array): flux fraction of each source inside the aperture
+     - CROWDSAP (float): flux fraction of the target inside the aperture
+     - n_sources (int, default 5): number of contaminant sources to consider individually
+
+    returns (idxs_selected, relative_contam, relative_contam_sorted, crowdsap_sorted):
+     - idxs_selected (array): indices of the n_sources most contaminant
+       sources, the most contaminant first
+     - relative_contam (list): their share of the contamination, plus that
+       of all the remaining ('Other') sources
+     - relative_contam_sorted (array): share of the contamination of every
+       contaminant source, from more to less contaminant
+     - crowdsap_sorted (array): flux fraction of every contaminant source
+       inside the aperture, from less to more contaminant
+    """
+    #all the indexes except that of the target star
+    idxs_contam = np.where(CROWDSAP_arr!=CROWDSAP)[0]
+    #contamination ratio of the contaminant sources, with respect to the overall contamination,
+    #from more to less contaminant
+    relative_contam_sorted = np.sort(CROWDSAP_arr[idxs_contam] / np.sum(CROWDSAP_arr[idxs_contam]))[::-1]
+    relative_contam = list(relative_contam_sorted[:n_sources])
+    relative_contam.extend([np.sum(relative_contam_sorted[n_sources:])]) #remaining contamination from 'Other' stars
+
+    #np.argsort does not have an argument 'reverse', so the highest CROWDSAPs are at the end of the array
+    idxs_crowdsap_sorted = np.argsort(CROWDSAP_arr)
+    idxs_crowdsap_sorted = idxs_crowdsap_sorted[CROWDSAP_arr[idxs_crowdsap_sorted] != CROWDSAP]
+    crowdsap_sorted  = CROWDSAP_arr[idxs_crowdsap_sorted]
+    idxs_selected = idxs_crowdsap_sorted[-n_sources:][::-1]
+    return idxs_selected, relative_contam, relative_contam_sorted, crowdsap_sorted
+
+class ContaminationResult:
+    """Contamination metrics of a target in a TPF
+
+    attributes:
+     - table (astropy Table): Gaia sources, with their 'flux' relative to the target
+     - idx_target (int): index of the target in `table`
+     - pixel_coords (array): (N,2) pixel coordinates of the sources, relative to the TPF
+     - contributions (sparse CSR matrix): flux of each source (rows) in each
+       TPF pixel (columns, flattened)
+     - resampled (array): total flux in each pixel
+     - resampled_target (array): flux of the target in each pixel
+     - CROWDSAP_pixel_by_pixel (array): flux ratio of the target in each pixel
+     - aperture_mask (boolean array): photometric aperture
+     - aperture_flux (array): flux of each source inside the aperture
+     - CROWDSAP_arr (array): flux fraction of each source inside the aperture
+     - CROWDSAP (float): flux fraction of the target inside the aperture
+     - FLFRCSAP (float): fraction of the target flux inside the aperture
+     - aperture_optimization (ApertureOptimization): optimal aperture and
+       trade-off curve, with aperture 'optimal' (None otherwise)
+     - neglected_flux (float): bound of the flux of the skipped sources in any pixel
+     - camera, ccd, sector (int), column, row (int), shape (int,int): TPF
+       location and size
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def contaminants(self, n_sources=5):
+        """Most contaminant sources inside the aperture (see rank_contaminants)"""
+        return rank_contaminants(self.CROWDSAP_arr, self.CROWDSAP, n_sources)
+
+    def optimize_aperture(self, **options):
+        """Aperture maximizing an objective of CROWDSAP and FLFRCSAP, from the
+        per-pixel fluxes of this result (see tesscont.aperture.optimize_aperture)"""
+        return optimize_aperture(self.resampled_target, self.resampled, **options)
+
+    def save(self, path):
+        """Save the result (pickle), to be re-loaded with load_result"""
+        import pickle
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __repr__(self):
+        return (f'<ContaminationResult sector {self.sector}: CROWDSAP = {self.CROWDSAP:.4f}, '
+                f'FLFRCSAP = {self.FLFRCSAP:.4f}, {len(self.table)} Gaia sources>')
+
+def load_result(path):
+    """Load a ContaminationResult saved with ContaminationResult.save"""
+    import pickle
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def compute_contamination(tpf, gaia_table, aperture='pipeline', method_prf='accurate', idx_target=None,
+                          tic=None, catalog='DR3', tic_crossmatch='mast', cache=True, pm_propagation='linear',
+                          gaussian_sigma=1., flux_tolerance=0., prf_bankdir=None, threshold_target=0.7,
+                          threshold_median=3, aperture_options=None, n_workers=1, verbose=False):
+    """Contamination of a target by the nearby Gaia sources in a TPF
+
+    inputs:
+     - tpf (lightkurve TargetPixelFile): TPF or tesscut of the target
+     - gaia_table (astropy Table): Gaia sources around the target (see
+       tesscont.query_gaia); sources without G magnitude are discarded
+     - aperture (str or boolean array, default 'pipeline'): see select_aperture, or
+       'optimal' (the aperture found by tesscont.aperture.optimize_aperture)
+     - method_prf (str, default 'accurate'): see build_contributions
+     - idx_target (int, default None): index of the target in gaia_table
+       (default: found with identify_target)
+     - tic, tic_crossmatch, cache: see identify_target
+     - catalog (str, default 'DR3'): Gaia data release of gaia_table
+     - pm_propagation (str, default 'linear'): see propagate_to_pixels
+     - gaussian_sigma, flux_tolerance, prf_bankdir, n_workers: see build_contributions
+     - threshold_target, threshold_median: see select_aperture
+     - aperture_options (dict, default None): objective, method, target_counts,
+       pixel_noise and max_pixels of optimize_aperture (aperture: optimal only)
+     - verbose (bool, default False): print the progress
+
+    returns a ContaminationResult
+    """
+    if np.ma.is_masked(gaia_table['Gmag']):
+        #we discard those targets with a 'nan' G magnitude
+        if idx_target is not None:
+            masked = np.ma.getmaskarray(gaia_table['Gmag'])
+            if masked[idx_target]:
+                raise ValueError(f'The target (row {idx_target} of the Gaia table) does not have a G magnitude')
+            idx_target = int(np.cumsum(~masked)[idx_target] - 1)
+        gaia_table = gaia_table[~np.ma.getmaskarray(gaia_table['Gmag'])]
+    table = gaia_table.copy()
+    if idx_target is None:
+        idx_target = identify_target(table, tpf, catalog=catalog, tic=tic, tic_crossmatch=tic_crossmatch,
+                                     cache=cache, verbose=verbose)
+
+    #flux of each star with respect to the flux of our target: f_star/f_target = 100**((m_target-m_star)/5)
+    table['flux'] = 100**((table['Gmag'][idx_target] - np.asarray(table['Gmag'], dtype = float)) / 5)
+
+    if verbose:
+        print(f'Extracting the Gaia {catalog} coordinates of the nearby targets '
+              'and converting them into pixel coordinates ... ')
+    coords, pixel_coords = propagate_to_pixels(table, tpf, catalog=catalog, pm_propagation=pm_propagation)
+
+    contributions, idxs_keep, neglected_flux = build_contributions(
+        tpf, pixel_coords, table['flux'], idx_target, method_prf=method_prf, gaussian_sigma=gaussian_sigma,
+        flux_tolerance=flux_tolerance, prf_bankdir=prf_bankdir, n_workers=n_workers, verbose=verbose)
+
+    #CROWDSAP pixel by pixel
+    resampled = np.asarray(contributions.sum(axis = 0)).reshape(tpf.shape[1:3])
+    resampled_target = contributions[idx_target].toarray().reshape(tpf.shape[1:3])
+    CROWDSAP_pixel_by_pixel = resampled_target / resampled
+
+    aperture_optimization = None
+    if isinstance(aperture, str) and aperture == 'optimal':
+        aperture_optimization = optimize_aperture(resampled_target, resampled, **(aperture_options or {}))
+        aperture_mask = aperture_optimization.mask
+    else:
+        aperture_mask = select_aperture(tpf, aperture, CROWDSAP_pixel_by_pixel, threshold_target=threshold_target,
+                                        threshold_median=threshold_median)
+
+    #flux of each source inside the aperture (a single sparse product of 'contributions' and the aperture
+    #mask). All the contamination metrics are simple reductions of this array
+    aperture_flux = contributions @ np.asarray(aperture_mask).ravel().astype(float)
+    #FLFRCSAP: flux fraction of the target star inside the aperture, compared to its total flux
+    FLFRCSAP = aperture_flux[idx_target]
+    #CROWDSAP: flux fraction of the target star inside the aperture, compared to the total flux inside
+    #the aperture coming from all the sources
+    CROWDSAP = aperture_flux[idx_target] / np.sum(aperture_flux)
+    CROWDSAP_arr = aperture_flux / np.sum(aperture_flux)
+
+    return ContaminationResult(table=table, idx_target=idx_target, pixel_coords=pixel_coords,
+                               contributions=contributions, resampled=resampled,
+                               resampled_target=resampled_target,
+                               CROWDSAP_pixel_by_pixel=CROWDSAP_pixel_by_pixel, aperture_mask=aperture_mask,
+                               aperture_flux=aperture_flux, CROWDSAP_arr=CROWDSAP_arr, CROWDSAP=CROWDSAP,
+                               FLFRCSAP=FLFRCSAP, aperture_optimization=aperture_optimization,
+                               neglected_flux=neglected_flux, idxs_keep=idxs_keep,
+                               method_prf=method_prf, camera=int(tpf.camera), ccd=int(tpf.ccd),
+                               sector=int(tpf.sector), column=int(tpf.column), row=int(tpf.row),
+                               shape=tuple(tpf.shape[1:3]))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gaia cone searches with a persistent local cache.
+
+Every VizieR query result is stored as an ECSV file under the cache directory
+(default ~/.cache/tess_cont, or $TESS_CONT_CACHE), indexed in a small SQLite
+database by catalog (DR2/DR3), centre and radius. A new cone search is served
+from any cached query of the same catalog whose cone contains it (i.e. a
+larger radius around a nearby centre), by filtering the cached sources
+locally, so re-running a target with a different sector, aperture or plotting
+option does not hit VizieR again.
+
+Queries can also be run fully offline against a local HEALPix-partitioned
+copy of the catalog (backend='local', see tesscont/healpix.py).
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+VIZIER_CATALOGS = {'DR3': 'I/355/gaiadr3', 'DR2': 'I/345/gaia2'}
+
+def default_cachedir():
+    """Local TESS-cont cache directory ($TESS_CONT_CACHE, or ~/.cache/tess_cont)"""
+    return os.environ.get('TESS_CONT_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'tess_cont'))
+
+def cone_filter(table, ra, dec, radius):
+    """Sources of `table` within `radius` arcsec of (ra, dec) [deg]"""
+    from astropy.coordinates import SkyCoord
+    coords = SkyCoord(np.ma.filled(table['RA_ICRS'].value, np.nan),
+                      np.ma.filled(table['DE_ICRS'].value, np.nan), unit='deg')
+    separation = coords.separation(SkyCoord(ra, dec, unit='deg')).arcsec
+    return table[separation <= radius]
+
+class GaiaCache:
+    """Persistent cache of Gaia cone searches
+
+    """
+    def __init__(self, cachedir=None):
+        """Open (and create, if needed) the cache.
+
+        inputs:
+         - cachedir (str, default None): cache root directory (see default_cachedir)
+        """
+        self.directory = os.path.join(cachedir or default_cachedir(), 'gaia')
+        os.makedirs(self.directory, exist_ok=True)
+        self.database = os.path.join(self.directory, 'queries.sqlite')
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS queries (catalog TEXT, ra REAL, '
+                               'dec REAL, radius REAL, filename TEXT, created REAL)')
+
+    def _connect(self):
+        #several processes may use the cache at the same time
+        return sqlite3.connect(self.database, timeout=60)
+
+    def get(self, catalog, ra, dec, radius):
+        """Cached sources within `radius` arcsec of (ra, dec), or None
+
+        Any cached query of the same catalog whose cone contains the
+        requested one is used (the smallest, if there are several).
+        """
+        with self._connect() as connection:
+            rows = connection.execute('SELECT ra, dec, radius, filename FROM queries WHERE '
+                                      'catalog = ? AND radius >= ? ORDER BY radius',
+                                      (catalog, radius)).fetchall()
+        if len(rows) == 0:
+            return None
+        from astropy.table import Table
+        from astropy.coordinates import SkyCoord
+        target = SkyCoord(ra, dec, unit='deg')
+        for cached_ra, cached_dec, cached_radius, filename in rows:
+            separation = target.separation(SkyCoord(cached_ra, cached_dec, unit='deg')).arcsec
+            path = os.path.join(self.directory, filename)
+            if separation + radius <= cached_radius + 1e-6 and os.path.exists(path):
+                #VizieR tables are masked, whether or not they have missing values
+                table = Table(Table.read(path, format='ascii.ecsv'), masked=True)
+                return cone_filter(table, ra, dec, radius)
+        return None
+
+    def put(self, catalog, ra, dec, radius, table):
+        """Store the result of a cone search"""
+        key = f'{catalog} {ra:.8f} {dec:.8f} {radius:.4f}'
+        filename = f'{catalog}_{hashlib.sha1(key.encode()).hexdigest()}.ecsv'
+        path = os.path.join(self.directory, filename)
+        #write to a temporary file first, so that concurrent runs never read
+        #a half-written table
+        tmp = f'{path}.{os.getpid()}.tmp'
+        table.write(tmp, format='ascii.ecsv', overwrite=True)
+        os.replace(tmp, path)
+        with self._connect() as connection:
+            connection.execute('INSERT INTO queries VALUES (?, ?, ?, ?, ?, ?)',
+                               (catalog, float(ra), float(dec), float(radius), filename, time.time()))
+
+def query_vizier(ra, dec, search_radius, catalog='DR3'):
+    """Gaia sources within search_radius arcsec of (ra, dec), from VizieR
+
+    returns None if the catalog has no sources there
+    """
+    from astroquery.vizier import Vizier
+    from astropy.coordinates import SkyCoord, Angle
+    Vizier.ROW_LIMIT = -1
+    gaia_cat = VIZIER_CATALOGS[catalog]
+    result = Vizier.query_region(SkyCoord(ra, dec, frame='icrs', unit='deg'), catalog=[gaia_cat],
+                                 radius=Angle(search_radius, "arcsec"))
+    try:
+        return result[gaia_cat]
+    except:
+        return None
+
+def query_local(ra, dec, search_radius, catalog='DR3', localdir=None):
+    """Gaia sources from a local HEALPix-partitioned catalog (see tesscont/healpix.py)"""
+    from .healpix import query_local
+    return query_local(ra, dec, search_radius, localdir, catalog=catalog)
+
+#Gaia backends: functions (ra, dec, search_radius, catalog, **options) returning
+#an astropy Table, or None if there are no sources. New ones can be added here.
+GAIA_BACKENDS = {'vizier': query_vizier, 'local': query_local}
+
+def query_gaia(ra, dec, search_radius, catalog='DR3', cache=True, cachedir=None,
+               backend='vizier', **options):
+    """Gaia cone search, served from the local cache whenever possible
+
+    inputs:
+     - ra, dec (float): centre of the cone [deg]
+     - search_radius (float): radius of the cone [arcsec]
+     - catalog (str, default 'DR3'): Gaia data release, DR2 or DR3
+     - cache (bool, default True): use (and fill) the local cache. Not used
+       with the 'local' backend, which is already local.
+     - cachedir (str, default None): cache root directory
+     - backend (str, default 'vizier'): one of GAIA_BACKENDS
+     - options: passed to the backend (e.g. localdir for 'local')
+
+    returns an astropy Table, or None if the catalog has no sources there
+    """
+    ra, dec, search_radius = float(ra), float(dec), float(search_radius)
+    query = GAIA_BACKENDS[backend]
+    if not cache or backend == 'local':
+        return query(ra, dec, search_radius, catalog, **options)
+    gaiacache = GaiaCache(cachedir)
+    result = gaiacache.get(catalog, ra, dec, search_radius)
+    if result is None:
+        result = query(ra, dec, search_radius, catalog, **options)
+        if result is not None:
+            gaiacache.put(catalog, ra, dec, search_radius, result)
+    return result
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar output of the TESS-cont products in an HDF5 file, appendable
+across runs and batches.
+
+With `hdf5_output: FILE.h5` in the OPTIONAL section, every run adds a group
+`/<target_name>/S<sector>` to FILE.h5 (replacing that of a previous run of
+the same target and sector), with:
+ - attributes: configuration file, target, TIC, sector, camera, CCD, TPF
+   column and row, aperture, PRF method, Gaia catalog, CROWDSAP, FLFRCSAP,
+   idx_target and neglected_flux
+ - CROWDSAP_pixel_by_pixel (float, ny x nx): flux ratio of the target in
+   each pixel, and aperture_mask (bool, ny x nx)
+ - sources/: one column per quantity of every Gaia source (Source, Gmag,
+   flux, column, row, aperture_flux, CROWDSAP, kept)
+ - contributions/: the flux of every source in every pixel, as a CSR
+   sparse matrix (data, indices, indptr, and a shape attribute)
+and appends a row to the columns of `/summary` (group, config_file,
+target_name, tic, sector, camera, ccd, CROWDSAP, FLFRCSAP, time), so that
+the metrics of all runs are read without opening every group. Arrays are
+read lazily: h5py only loads what is sliced. Writers take an exclusive
+lock on FILE.h5.lock (a sidecar file left next to FILE.h5), so that runs
+in parallel processes (e.g. the multi-sector mode) can append to the same
+file. The summary row is checked before the file is touched, and all its
+columns are resized together, so that they always have the same length.
+
+Requires h5py (pip install h5py).
+"""
+import os
+import time
+import numpy as np
+from .metrics import _locked
+
+SUMMARY_COLUMNS = {'group': 'str', 'config_file': 'str', 'target_name': 'str', 'tic': 'str',
+                   'sector': 'i8', 'camera': 'i8', 'ccd': 'i8', 'CROWDSAP': 'f8', 'FLFRCSAP': 'f8',
+                   'time': 'f8'}
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('The HDF5 output requires h5py (pip install h5py)')
+    return h5py
+
+def _summary_row(row):
+    #values of the summary columns, checked and converted (ValueError if any is not a scalar)
+    values = {}
+    for name, kind in SUMMARY_COLUMNS.items():
+        value = row.get(name)
+        if kind == 'str':
+            values[name] = '' if value is None else str(value)
+            continue
+        value = np.asarray(-1 if value is None else value)
+        if value.ndim != 0:
+            raise ValueError(f'The summary column {name} takes a scalar, not {value!r}')
+        values[name] = value.astype(kind)[()]
+    return values
+
+def _append_summary(h5file, values):
+    h5py = _h5py()
+    summary = h5file.require_group('summary')
+    for name, kind in SUMMARY_COLUMNS.items():
+        if name not in summary:
+            dtype = h5py.string_dtype() if kind == 'str' else np.dtype(kind)
+            summary.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(1024,))
+    #all the columns grow together (to the length of the shortest, should a write have been interrupted)
+    n_rows = min(len(summary[name]) for name in SUMMARY_COLUMNS)
+    for name in SUMMARY_COLUMNS:
+        summary[name].resize((n_rows + 1,))
+    for name, value in values.items():
+        summary[name][n_rows] = value
+
+def write_hdf5(path, result, config_file='', target=None, target_name=None, tic=None, aperture=None,
+               catalog=None, contributions=True):
+    """Add the products of a run to an HDF5 file
+
+    inputs:
+     - path (str): HDF5 file (created if needed)
+     - result (ContaminationResult)
+     - config_file, target, target_name, tic, aperture, catalog: keys of the
+       run (target_name defaults to target, or 'Target')
+     - contributions (bool, default True): save the per-pixel contributions
+       of every source (the largest product)
+
+    returns the name of the group of the run
+    """
+    h5py = _h5py()
+    target_name = str(target_name or target or 'Target')
+    group_name = f'{target_name}/S{result.sector}'
+    coords = np.asarray(result.pixel_coords, dtype=float)
+    table = result.table
+    kept = np.zeros(len(table), dtype=bool)
+    kept[np.asarray(result.idxs_keep, dtype=int)] = True
+
+    attributes = {'config_file': config_file, 'target': target, 'target_name': target_name, 'tic': tic,
+                  'sector': result.sector, 'camera': result.camera, 'ccd': result.ccd,
+                  'column': result.column, 'row': result.row, 'aperture': aperture,
+                  'method_prf': result.method_prf, 'catalog': catalog, 'CROWDSAP': result.CROWDSAP,
+                  'FLFRCSAP': result.FLFRCSAP, 'idx_target': result.idx_target,
+                  'neglected_flux': result.neglected_flux}
+    #checked before the file is touched
+    summary_row = _summary_row(dict(attributes, group=group_name, time=time.time()))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _locked(path), h5py.File(path, 'a') as h5file:
+        if group_name in h5file:
+            del h5file[group_name]
+        group = h5file.create_group(group_name)
+        for key, value in attributes.items():
+            if value is not None:
+                group.attrs[key] = value if np.isscalar(value) else str(value)
+
+        group.create_dataset('CROWDSAP_pixel_by_pixel', data=np.asarray(result.CROWDSAP_pixel_by_pixel, dtype=float))
+        group.create_dataset('aperture_mask', data=np.asarray(result.aperture_mask, dtype=bool))
+
+        sources = group.create_group('sources')
+        columns = {'Source': np.asarray(table['Source'], dtype=np.int64),
+                   'Gmag': np.ma.filled(np.ma.asarray(table['Gmag'], dtype=float), np.nan),
+                   'flux': np.asarray(table['flux'], dtype=float),
+                   'column': coords[:, 0] + result.column, 'row': coords[:, 1] + result.row,
+                   'aperture_flux': np.asarray(result.aperture_flux, dtype=float),
+                   'CROWDSAP': np.asarray(result.CROWDSAP_arr, dtype=float), 'kept': kept}
+        for name, values in columns.items():
+            sources.create_dataset(name, data=values, compression='gzip', shuffle=True)
+
+        if contributions:
+            from scipy.sparse import csr_matrix
+            matrix = csr_matrix(result.contributions)
+            sparse = group.create_group('contributions')
+            sparse.attrs['shape'] = matrix.shape
+            for name in ['data', 'indices', 'indptr']:
+                sparse.create_dataset(name, data=getattr(matrix, name), compression='gzip', shuffle=True)
+
+        _append_summary(h5file, summary_row)
+    return group_name
+
+def read_summary(path, latest=True):
+    """pandas DataFrame with the summary of all the runs in an HDF5 file
+
+    With latest=True, only the last run of each group (target and sector) is kept.
+    """
+    import pandas as pd
+    h5py = _h5py()
+    with h5py.File(path, 'r') as h5file:
+        if 'summary' not in h5file:
+            return pd.DataFrame(columns=list(SUMMARY_COLUMNS))
+        summary = h5file['summary']
+        n_rows = min(len(summary[name]) for name in SUMMARY_COLUMNS)
+        data = {}
+        for name, kind in SUMMARY_COLUMNS.items():
+            values = summary[name][:n_rows]
+            data[name] = [value.decode() for value in values] if kind == 'str' else values
+    summary = pd.DataFrame(data)
+    if latest:
+        summary = summary.drop_duplicates('group', keep='last').reset_index(drop=True)
+    return summary
+
+def read_run(path, group):
+    """Products of one run (e.g. group 'TOI-5005/S65') of an HDF5 file
+
+    returns a dict with the attributes of the run, the CROWDSAP_pixel_by_pixel
+    and aperture_mask arrays, a pandas DataFrame 'sources', and, if saved,
+    the 'contributions' (scipy.sparse CSR matrix, sources x TPF pixels)
+    """
+    import pandas as pd
+    h5py = _h5py()
+    with h5py.File(path, 'r') as h5file:
+        run = h5file[group]
+        products = dict(run.attrs)
+        products['CROWDSAP_pixel_by_pixel'] = run['CROWDSAP_pixel_by_pixel'][:]
+        products['aperture_mask'] = run['aperture_mask'][:]
+        products['sources'] = pd.DataFrame({name: run['sources'][name][:] for name in run['sources']})
+        if 'contributions' in run:
+            from scipy.sparse import csr_matrix
+            sparse = run['contributions']
+            products['contributions'] = csr_matrix((sparse['data'][:], sparse['indices'][:], sparse['indptr'][:]),
+                                                   shape=tuple(sparse.attrs['shape']))
+    return products
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline Gaia backend, reading a local copy of the catalog partitioned by
+HEALPix pixel.
+
+A local catalog is a directory holding a `partitions.json` file with the
+catalog (DR2/DR3) and HEALPix order (nested scheme, ICRS), plus one
+`hpx<order>_<pixel>.npy` structured array per non-empty HEALPix pixel, with
+only the columns TESS-cont uses (Source, RA_ICRS, DE_ICRS, pmRA, pmDE, Gmag,
+and Plx if available; missing values stored as NaN). A cone search loads just
+the partitions overlapping the cone and selects sources with a vectorized
+angular distance, so no network access is needed.
+
+To build a local catalog from any table with those columns (e.g. a Gaia
+archive export, in any format astropy can read):
+
+    python -m tesscont.healpix gaia_subset.fits LOCALDIR [--catalog DR3] [--order 6]
+
+Requires astropy-healpix (pip install astropy-healpix).
+"""
+import os
+import json
+import argparse
+import numpy as np
+from astropy.table import Table
+
+GAIA_COLUMNS = ['Source', 'RA_ICRS', 'DE_ICRS', 'pmRA', 'pmDE', 'Gmag']
+OPTIONAL_COLUMNS = ['Plx']
+
+def _healpix(order):
+    try:
+        from astropy_healpix import HEALPix
+    except ImportError:
+        raise ImportError('The local Gaia backend requires astropy-healpix '
+                          '(pip install astropy-healpix)')
+    from astropy.coordinates import ICRS
+    return HEALPix(nside=2**order, order='nested', frame=ICRS())
+
+def _partition_name(order, pixel):
+    return f'hpx{order}_{pixel}.npy'
+
+def build_catalog(table, localdir, catalog='DR3', order=6):
+    """Partition a Gaia table by HEALPix pixel into a local catalog
+
+    inputs:
+     - table (astropy Table): Gaia sources, with at least the GAIA_COLUMNS
+     - localdir (str): output directory; sources are appended to any
+       existing partitions (the order and catalog must then match)
+     - catalog (str, default 'DR3'): Gaia data release of the table
+     - order (int, default 6): HEALPix order of the partitions (~0.9 deg pixels)
+    """
+    from astropy import units as u
+    os.makedirs(localdir, exist_ok=True)
+    metafile = os.path.join(localdir, 'partitions.json')
+    if os.path.exists(metafile):
+        with open(metafile) as f:
+            meta = json.load(f)
+        if meta['catalog'] != catalog or meta['order'] != order:
+            raise ValueError(f'{localdir} holds a {meta["catalog"]} catalog of order {meta["order"]}')
+    columns = GAIA_COLUMNS + [column for column in OPTIONAL_COLUMNS if column in table.colnames]
+
+    dtype = [('Source', 'i8')] + [(column, 'f8') for column in columns[1:]]
+    data = np.zeros(len(table), dtype=dtype)
+    data['Source'] = np.asarray(table['Source'])
+    for column in columns[1:]:
+        data[column] = np.ma.filled(np.ma.asarray(table[column], dtype=float), np.nan)
+
+    pixels = _healpix(order).lonlat_to_healpix(data['RA_ICRS']*u.deg, data['DE_ICRS']*u.deg)
+    for pixel in np.unique(pixels):
+        path = os.path.join(localdir, _partition_name(order, pixel))
+        partition = data[pixels == pixel]
+        if os.path.exists(path):
+            partition = np.concatenate([np.load(path), partition])
+        np.save(path, partition)
+    with open(metafile, 'w') as f:
+        json.dump({'catalog': catalog, 'order': order, 'columns': columns}, f)
+
+def query_local(ra, dec, search_radius, localdir, catalog='DR3'):
+    """Gaia sources within search_radius arcsec of (ra, dec), from a local catalog
+
+    returns a masked astropy Table (missing values masked, as from VizieR),
+    or None if there are no sources there
+    """
+    from astropy import units as u
+    with open(os.path.join(localdir, 'partitions.json')) as f:
+        meta = json.load(f)
+    if meta['catalog'] != catalog:
+        raise ValueError(f'{localdir} holds the Gaia {meta["catalog"]} catalog, not {catalog}')
+    healpix = _healpix(meta['order'])
+
+    #partitions overlapping the cone (radius padded by one pixel, to make
+    #sure partially covered pixels are included)
+    radius = search_radius*u.arcsec + healpix.pixel_resolution
+    pixels = healpix.cone_search_lonlat(ra*u.deg, dec*u.deg, radius)
+    paths = [os.path.join(localdir, _partition_name(meta['order'], pixel)) for pixel in pixels]
+    partitions = [np.load(path) for path in paths if os.path.exists(path)]
+    if len(partitions) == 0:
+        return None
+    data = np.concatenate(partitions)
+
+    #angular distance (haversine)
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    ras, decs = np.radians(data['RA_ICRS']), np.radians(data['DE_ICRS'])
+    hav = (np.sin((decs - dec0)/2)**2 +
+           np.cos(decs)*np.cos(dec0)*np.sin((ras - ra0)/2)**2)
+    separation = np.degrees(2*np.arcsin(np.sqrt(np.clip(hav, 0, 1))))*3600
+    data = data[separation <= search_radius]
+    if len(data) == 0:
+        return None
+
+    result = Table(masked=True)
+    for column in data.dtype.names:
+        result[column] = np.ma.masked_invalid(data[column]) if column != 'Source' else data[column]
+    for column in ['RA_ICRS', 'DE_ICRS']:
+        result[column].unit = u.deg
+    for column in ['pmRA', 'pmDE']:
+        result[column].unit = u.mas/u.yr
+    if 'Plx' in result.colnames:
+        result['Plx'].unit = u.mas
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m tesscont.healpix',
+                                     description='Build a local HEALPix-partitioned Gaia catalog.')
+    parser.add_argument('table', help='Gaia table (any format readable by astropy)')
+    parser.add_argument('localdir')
+    parser.add_argument('--catalog', default='DR3', choices=['DR2', 'DR3'])
+    parser.add_argument('--order', type=int, default=6)
+    args = parser.parse_args()
+    build_catalog(Table.read(args.table), args.localdir, catalog=args.catalog, order=args.order)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Metrics store: the CROWDSAP and FLFRCSAP of every run, safe for many
+concurrent writers.
+
+    python -m tesscont.metrics export [--database metrics.sqlite] [--output metrics.dat]
+    python -m tesscont.metrics compact [--database metrics.sqlite]
+    python -m tesscont.metrics import metrics.dat [--database metrics.sqlite]
+
+Every run with `save_metrics: True` appends one record (configuration file,
+target, TIC, sector, camera, CCD, aperture, PRF method, Gaia catalog,
+CROWDSAP, FLFRCSAP, time) to an SQLite database in the working directory
+(metrics.sqlite), in a single transaction, so that runs in parallel
+processes (batch runs, multi-sector runs, or several TESS-cont.py at once)
+neither lose nor corrupt records. metrics.dat, with the latest metrics of
+each configuration file (the layout written by earlier versions), is then
+exported from the store, and replaced atomically (the exports are
+serialized with a lock on metrics.dat.lock, so that the last one written
+is the most recent). Inside deferred_export
+(used by the batch runner and the multi-sector mode, and inherited by
+their forked workers) it is exported only once, at the end.
+
+`compact` keeps only the latest record of each configuration file, and
+`import` loads an existing metrics.dat into the store (done automatically
+when the store is opened next to a metrics.dat it has not imported yet,
+in the transaction that creates the store, before any record or export).
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+DATABASE = 'metrics.sqlite'
+CSV = 'metrics.dat'
+
+COLUMNS = ['config_file', 'target', 'target_name', 'tic', 'sector', 'camera', 'ccd', 'aperture',
+           'method_prf', 'catalog', 'CROWDSAP', 'FLFRCSAP', 'time']
+
+@contextmanager
+def _locked(path):
+    #exclusive lock of the file for the writers (where fcntl is available)
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+class MetricsStore:
+    """Append-only store of contamination metrics (SQLite)
+
+    """
+    def __init__(self, database=DATABASE, legacy=CSV):
+        """Open (and create, if needed) the store.
+
+        inputs:
+         - database (str, default 'metrics.sqlite'): SQLite file
+         - legacy (str, default 'metrics.dat'): metrics file written by earlier
+           versions, imported once (see import_csv); None to skip it
+        """
+        self.database = database
+        connection = self._connect()
+        try:
+            #write-ahead log: readers do not block the writers
+            connection.execute('PRAGMA journal_mode=WAL')
+            #the schema and the legacy import in a single transaction: concurrent
+            #first runs wait here, so that the import reads metrics.dat before any
+            #of them records or exports anything
+            self._transaction(connection, lambda: self._create(connection, legacy))
+        finally:
+            connection.close()
+
+    def _connect(self):
+        #several processes may write at the same time
+        return sqlite3.connect(self.database, timeout=60)
+
+    @staticmethod
+    def _transaction(connection, function):
+        #function() inside a BEGIN IMMEDIATE transaction (a single writer)
+        connection.isolation_level = None
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            value = function()
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def _create(self, connection, legacy):
+        connection.execute('CREATE TABLE IF NOT EXISTS metrics '
+                           '(id INTEGER PRIMARY KEY AUTOINCREMENT, config_file TEXT, target TEXT, '
+                           'target_name TEXT, tic TEXT, sector INTEGER, camera INTEGER, ccd INTEGER, '
+                           'aperture TEXT, method_prf TEXT, catalog TEXT, CROWDSAP REAL, FLFRCSAP REAL, '
+                           'time REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS metrics_config ON metrics (config_file)')
+        connection.execute('CREATE TABLE IF NOT EXISTS imported (path TEXT PRIMARY KEY)')
+        if legacy is not None:
+            self._import(connection, legacy)
+
+    @staticmethod
+    def _import(connection, path):
+        #rows of a metrics.dat not imported yet (inside a transaction)
+        import pandas as pd
+        path_key = os.path.abspath(path)
+        if connection.execute('SELECT 1 FROM imported WHERE path = ?', [path_key]).fetchone():
+            return 0
+        connection.execute('INSERT INTO imported VALUES (?)', [path_key])
+        if not os.path.exists(path):
+            return 0
+        known = {row[0] for row in connection.execute('SELECT DISTINCT config_file FROM metrics')}
+        table = pd.read_csv(path)
+        table.columns = [column.strip() for column in table.columns]
+        rows = [(str(row.config_file), float(row.CROWDSAP), float(row.FLFRCSAP), 0.)
+                for row in table.itertuples() if str(row.config_file) not in known]
+        connection.executemany('INSERT INTO metrics (config_file, CROWDSAP, FLFRCSAP, time) '
+                               'VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def record(self, config_file, CROWDSAP, FLFRCSAP, **keys):
+        """Append the metrics of a run
+
+        inputs:
+         - config_file (str): configuration file of the run
+         - CROWDSAP, FLFRCSAP (float): metrics
+         - keys: target, target_name, tic, sector, camera, ccd, aperture,
+           method_prf, catalog (any of them; the others are left empty)
+        """
+        unknown = set(keys) - set(COLUMNS)
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown metrics keys: {", ".join(sorted(unknown))}')
+        row = dict(keys, config_file=str(config_file), CROWDSAP=float(CROWDSAP), FLFRCSAP=float(FLFRCSAP),
+                   time=time.time())
+        for key in ['target', 'target_name', 'tic', 'aperture', 'method_prf', 'catalog']:
+            if row.get(key) is not None:
+                row[key] = str(row[key])
+        for key in ['sector', 'camera', 'ccd']:
+            if row.get(key) is not None:
+                row[key] = int(row[key])
+        columns = [column for column in COLUMNS if column in row]
+        with self._connect() as connection:
+            connection.execute(f'INSERT INTO metrics ({", ".join(columns)}) VALUES '
+                               f'({", ".join("?"*len(columns))})', [row[column] for column in columns])
+
+    def records(self):
+        """pandas DataFrame of all the records, oldest first"""
+        import pandas as pd
+        with self._connect() as connection:
+            return pd.read_sql_query(f'SELECT {", ".join(COLUMNS)} FROM metrics ORDER BY id', connection)
+
+    def latest(self):
+        """pandas DataFrame with the latest record of each configuration file,
+        in the order in which the configuration files were first recorded"""
+        import pandas as pd
+        with self._connect() as connection:
+            return pd.read_sql_query(f'SELECT {", ".join("m." + column for column in COLUMNS)} FROM metrics m '
+                                     'JOIN (SELECT MAX(id) AS last, MIN(id) AS first FROM metrics '
+                                     'GROUP BY config_file) g ON m.id = g.last ORDER BY g.first', connection)
+
+    def export_csv(self, path=CSV):
+        """Write the latest CROWDSAP and FLFRCSAP of each configuration file
+        (metrics.dat layout), replacing the file atomically"""
+        #one export at a time, so that an older snapshot never replaces a newer one
+        with _locked(path):
+            latest = self.latest()[['config_file', 'CROWDSAP', 'FLFRCSAP']]
+            temporary = f'{path}.{os.getpid()}.tmp'
+            latest.to_csv(temporary, index=False)
+            os.replace(temporary, path)
+        return latest
+
+    def compact(self):
+        """Delete all but the latest record of each configuration file"""
+        with self._connect() as connection:
+            deleted = connection.execute('DELETE FROM metrics WHERE id NOT IN '
+                                         '(SELECT MAX(id) FROM metrics GROUP BY config_file)').rowcount
+        connection = self._connect()
+        connection.execute('VACUUM')
+        connection.close()
+        return deleted
+
+    def import_csv(self, path=CSV):
+        """Load a metrics.dat file (config_file, CROWDSAP, FLFRCSAP) into the
+        store, once; configuration files already in the store are skipped"""
+        connection = self._connect()
+        try:
+            #a single transaction (and writer), so that concurrent imports are done once
+            return self._transaction(connection, lambda: self._import(connection, path))
+        finally:
+            connection.close()
+
+#True inside deferred_export
+_deferred = False
+
+@contextmanager
+def deferred_export(database=DATABASE, path=CSV, export=True):
+    """Export metrics.dat once on exit, rather than after every save_metrics call"""
+    global _deferred
+    deferred, _deferred = _deferred, True
+    try:
+        yield
+    finally:
+        _deferred = deferred
+        if export and not deferred and os.path.exists(database):
+            MetricsStore(database, legacy=path).export_csv(path)
+
+def save_metrics(config_file, CROWDSAP, FLFRCSAP, database=DATABASE, path=CSV, **keys):
+    """Record the metrics of a run (see MetricsStore.record), and export metrics.dat"""
+    #(an existing metrics.dat, written by earlier versions, is imported when the store is opened)
+    store = MetricsStore(database, legacy=path)
+    store.record(config_file, CROWDSAP, FLFRCSAP, **keys)
+    if not _deferred:
+        store.export_csv(path)
+    return store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m tesscont.metrics',
+                                     description='Export, compact, or import the TESS-cont metrics store.')
+    parser.add_argument('command', choices=['export', 'compact', 'import'])
+    parser.add_argument('file', nargs='?', default=CSV,
+                        help='metrics.dat file to import (import only)')
+    parser.add_argument('--database', default=DATABASE, help='SQLite metrics store')
+    parser.add_argument('--output', default=CSV, help='CSV file to export to (export only)')
+    args = parser.parse_args()
+
+    if args.command != 'import' and not os.path.exists(args.database):
+        print(f'Error: there is no metrics store {args.database}')
+        sys.exit(1)
+    store = MetricsStore(args.database, legacy=None if args.command == 'import' else CSV)
+    if args.command == 'export':
+        latest = store.export_csv(args.output)
+        print(f'The metrics of {len(latest)} configuration files have been saved in {args.output}')
+    elif args.command == 'compact':
+        print(f'{store.compact()} superseded records deleted')
+    else:
+        print(f'{store.import_csv(args.file)} configuration files imported from {args.file}')
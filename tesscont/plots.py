@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Figures of TESS-cont: the pie chart of the contamination inside the
+aperture, and the heatmap of the flux ratio of the target in each pixel.
+
+Both are drawn from a ContaminationResult (see tesscont/contamination.py)
+plus presentation options, so they can be made (or re-made) without
+recomputing anything. matplotlib is only imported when a figure is drawn.
+"""
+import numpy as np
+from colorsys import hsv_to_rgb
+
+#Generate fancy color palettes
+#from https://stackoverflow.com/questions/876853/generating-color-ranges-in-python
+def get_hex_color_list(num_colors=5, saturation=0.4, value=1.0):
+    hex_colors = []
+    hsv_colors = [[float(x / num_colors), saturation, value] for x in range(num_colors)]
+
+    for hsv in hsv_colors:
+        hsv = [int(x * 255) for x in hsv_to_rgb(*hsv)]
+
+        #Formatted as hexadecimal string using the ':02x' format specifier
+        hex_colors.append(f"#{hsv[0]:02x}{hsv[1]:02x}{hsv[2]:02x}")
+
+    return hex_colors
+
+#Transformation of previous color list (get_hex_color_list) to instead have rgb output (added by YGCF)
+def get_rgb_color_list(num_colors=5, saturation=0.4, value=1.0):
+    rgb_colors = []
+    hsv_colors = [[float(x / num_colors), saturation, value] for x in range(num_colors)]
+    for hsv in hsv_colors:
+        rgb = [x for x in hsv_to_rgb(*hsv)]
+        rgb_colors.append(rgb)
+    return rgb_colors
+
+def bar_labels(n_selected):
+    """Labels of the contaminant sources: Star#1 is the most contaminant within
+    the aperture, Star#2 the second most contaminant, etc., plus 'Other'"""
+    return [f'Star {i+1}' for i in range(n_selected)] + ['Other']
+
+def save_figure(fig, basename, img_fmt='pdfpng'):
+    """Save a figure as basename.pdf and/or basename.png (400 dpi)
+
+    img_fmt: 'pdf', 'png', or 'pdfpng'
+
+    The pdf keeps the default dpi (which also sets the resolution of images
+    such as the heatmap), unless the figure has rasterized layers, which are
+    then drawn at 400 dpi.
+
+    returns the saved file names
+    """
+    paths = []
+    if img_fmt == 'pdf' or img_fmt == 'pdfpng':
+        rasterized = any(artist.get_rasterized() for artist in fig.findobj())
+        fig.savefig(basename + '.pdf', bbox_inches = 'tight', pad_inches = 0, **({'dpi': 400} if rasterized else {}))
+        paths.append(basename + '.pdf')
+    if img_fmt == 'png' or img_fmt == 'pdfpng':
+        fig.savefig(basename + '.png', bbox_inches = 'tight', pad_inches = 0, dpi = 400)
+        paths.append(basename + '.png')
+    return paths
+
+def plot_piechart(result, n_sources=5):
+    """Pie chart of the flux inside the aperture (target vs nearby stars),
+    with a bar splitting the contamination between the main contaminants
+
+    returns the matplotlib figure
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import ConnectionPatch
+
+    CROWDSAP = result.CROWDSAP
+    idxs_selected, relative_contam, _, _ = result.contaminants(n_sources)
+    labels = bar_labels(len(idxs_selected))
+
+    # make figure and assign axis objects
+    fig, (ax1, ax2) = plt.subplots(1, 2, gridspec_kw={'width_ratios': [1,6]}, figsize=(6.93, 5.5))
+    fig.subplots_adjust(top = 1.41, bottom = 0, right = 1, left = 0,
+            hspace = 0, wspace = 0)
+
+    #------PIE CHART-----#
+
+    # pie chart parameters
+    pie_ratios = [1-CROWDSAP, CROWDSAP]
+    pie_labels = ['', '           ']
+    pie_colors = ['lightgrey','#25BDB0']
+    explode = [0.5, 0]
+    # rotate so that first wedge is split by the x-axis
+    angle = -180 * pie_ratios[0]
+    wedges, *_ = ax1.pie(pie_ratios, startangle=angle, explode=explode,
+                         colors = pie_colors, radius = 6, labels = pie_labels)
+
+    #-----------------------Pie chart percentages inside the pie------------------------
+    #+++Nearby stars+++
+    if pie_ratios[0] >= 0.9995:
+        ax1.text(1.60, -0.2, f'Nearby ({"{:1.2f}".format(pie_ratios[0]*100)}%)', fontsize = 17)
+    if 0.000995 < pie_ratios[0] < 0.0995:
+        ax1.text(1.20, -0.2, f'Nearby ({"{:1.1f}".format(pie_ratios[0]*100)}%)', fontsize = 17)
+    if pie_ratios[0] < 0.000995:
+        ax1.text(0.80, -0.2, f'Nearby ({"{:1.2f}".format(pie_ratios[0]*100)}%)', fontsize = 17)
+    if 0.0995 < pie_ratios[0] < 0.9995:
+        ax1.text(1.45, -0.2, f'Nearby ({"{:1.1f}".format(pie_ratios[0]*100)}%)', fontsize = 17)
+    #+++Target star+++
+    if pie_ratios[1] >= 0.9995:
+        ax1.text(-5.2, -0.2, f'Target ({"{:1.2f}".format(pie_ratios[1]*100)}%)', fontsize = 17)
+    if 0.000995 < pie_ratios[1] < 0.0995:
+        ax1.text(-4.9, -0.2, f'Target ({"{:1.1f}".format(pie_ratios[1]*100)}%)', fontsize = 17)
+    if pie_ratios[1] < 0.000995:
+        ax1.text(-5.125, -0.2, f'Target ({"{:1.2f}".format(pie_ratios[1]*100)}%)', fontsize = 17)
+    if 0.0995 < pie_ratios[1] < 0.9995:
+        ax1.text(-5.125, -0.2, f'Target ({"{:1.1f}".format(pie_ratios[1]*100)}%)', fontsize = 17)
+
+    #------BAR CHART-----#
+
+    # bar chart parameters
+    bar_ratios = relative_contam
+    bar_colors = get_hex_color_list(num_colors = n_sources+1, saturation = 0.5, value = 1.0)
+    bottom = 1
+    width = 0.25
+
+    # Adding from the top matches the legend.
+    for j, (height, label) in enumerate(sorted([*zip(bar_ratios, labels)])):
+        bottom -= height
+        bc = ax2.bar(0, height, width, bottom=bottom, color=bar_colors[j], label=label)
+        ax2.bar_label(bc, labels=[f"{height:0.0%}"], label_type='center', fontsize = 17)
+
+    ax2.legend(bbox_to_anchor=(0.420,1.422), loc="upper left",
+               bbox_transform=fig.transFigure, fontsize = 18, framealpha=0.8)
+    ax2.axis('off')
+    ax2.set_xlim(- 1 , 0.3)
+    ax2.set_ylim(-0.05, 1.0)
+
+    # use ConnectionPatch to draw lines between the two plots
+    theta1, theta2 = wedges[0].theta1, wedges[0].theta2
+    center, r = wedges[0].center, wedges[0].r
+    bar_height = sum(bar_ratios)
+
+    # draw top connecting line
+    x = r * np.cos(np.pi / 180 * theta2) + center[0]
+    y = r * np.sin(np.pi / 180 * theta2) + center[1]
+    con = ConnectionPatch(xyA=(-width / 2, bar_height), coordsA=ax2.transData,
+                          xyB=(x, y), coordsB=ax1.transData)
+    con.set_color('k')
+    con.set_linewidth(2)
+    ax2.add_artist(con)
+
+    # draw bottom connecting line
+    x = r * np.cos(np.pi / 180 * theta1) + center[0]
+    y = r * np.sin(np.pi / 180 * theta1) + center[1]
+    con = ConnectionPatch(xyA=(-width / 2, 0), coordsA=ax2.transData,
+                          xyB=(x, y), coordsB=ax1.transData)
+    con.set_color('k')
+    ax2.add_artist(con)
+    con.set_linewidth(2)
+    return fig
+
+def plot_heatmap(result, target_name, n_sources=5, scale_heatmap='log', colormap='viridis',
+                 plot_percentages=True, plot_target=True, plot_main_contaminants=True, plot_all_gaia=True,
+                 scale_factor=4000, loc_legend='best', plot_target_name=False, rasterized=False):
+    """Heatmap of the flux ratio of the target in each pixel, with the
+    aperture and the Gaia sources (disk areas proportional to their fluxes)
+
+    inputs:
+     - result (ContaminationResult)
+     - target_name (str): name of the target, for the legend
+     - n_sources (int, default 5): number of contaminant sources to highlight
+     - scale_heatmap (str, default 'log'): 'log' or 'natural'
+     - colormap (str, default 'viridis'): matplotlib colormap
+     - plot_percentages (bool, default True): overplot the flux ratio of each pixel
+     - plot_target, plot_main_contaminants, plot_all_gaia (bool, default True):
+       which sources to plot
+     - scale_factor (float, default 4000): size of the disks
+     - loc_legend (str, default 'best'): legend location
+     - plot_target_name (bool, default False): name the target in the colorbar label
+     - rasterized (bool, default False): rasterize the dense layers (the Gaia
+       sources and the pixel percentages) in vector outputs (pdf)
+
+    returns the matplotlib figure
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib import patches, colors
+    from matplotlib.collections import PatchCollection
+    import matplotlib.gridspec as gridspec
+    from matplotlib.colorbar import Colorbar
+    import astropy.visualization as stretching
+    from matplotlib.collections import PathCollection
+    from matplotlib.legend_handler import HandlerPathCollection
+    from astropy.visualization.mpl_normalize import ImageNormalize
+
+    column, row = result.column, result.row
+    ny, nx = result.shape
+    CROWDSAP_pixel_by_pixel = result.CROWDSAP_pixel_by_pixel
+    aperture_mask = result.aperture_mask
+    pixel_coords, flux, idx_target = result.pixel_coords, result.table['flux'], result.idx_target
+    idxs_selected, relative_contam, _, _ = result.contaminants(n_sources)
+    labels = bar_labels(len(idxs_selected))
+
+    fig = plt.figure(figsize=(6.93, 5.5))
+    gs = gridspec.GridSpec(1,3, height_ratios=[1], width_ratios=[1,0.05,0.01])
+    gs.update(left=0.05, right=0.95, bottom=0.12, top=0.95, wspace=0.01, hspace=0.03)
+    ax1 = plt.subplot(gs[0,0])
+    maskcolor = 'red'
+
+    #heatmap scale
+    if scale_heatmap == 'natural':
+        norm = ImageNormalize(vmin = 0, vmax = 100)
+    else:
+        norm = ImageNormalize(stretch=stretching.LogStretch(), vmin = 0.1, vmax = 99)
+
+    splot = plt.imshow(CROWDSAP_pixel_by_pixel*100,
+                       zorder=0,alpha =1,
+              extent=[column-0.5,column+nx-0.5,row+ny-0.5,row-0.5], norm = norm, cmap = colormap)
+
+    #aperture: a filled and an outlined square per pixel, in a single collection (drawn in the same order
+    #as individual patches, so that the overlapping edges look the same)
+    rows, cols = np.nonzero(aperture_mask)
+    squares = []
+    for i, j in zip(rows, cols):
+        square = patches.Rectangle((j+column-0.5, i+row-0.5), 1, 1)
+        squares.extend([square, square])
+    fill, edge = colors.to_rgba(maskcolor, 0.3), colors.to_rgba(maskcolor, 1)
+    ax1.add_collection(PatchCollection(squares, facecolors=[fill, 'none']*len(rows), edgecolors=[fill, edge]*len(rows),
+                                       linewidths=[plt.rcParams['patch.linewidth'], 2]*len(rows),
+                                       joinstyle='miter', zorder=1), autolim=False)
+
+    if plot_percentages:
+        percentages = np.round(CROWDSAP_pixel_by_pixel * 100, 1)
+        #trick to avoid 100.0 values (put instead 100)
+        labels_pixels = [str(100) if value == 100.0 else str(value) for value in percentages.ravel()]
+        for (i, j), label in zip(np.ndindex(ny, nx), labels_pixels):
+            ax1.text(j+column, i+row, label, ha="center", va="center", color="k", zorder = 1000, fontsize = 10.5,
+                     rasterized = rasterized)
+
+    plt.xlabel('Pixel Column Number', fontsize=14, zorder=200)
+    plt.ylabel('Pixel Row Number', fontsize=14, zorder=200)
+    plt.xticks(fontsize=12)
+    plt.yticks(fontsize=12)
+
+    #---Include the star locations within the plot----
+    #The circle sizes are scaled to the stellar fluxes (table['flux']). In particular, the 's' parameter
+    #is proportional to table['flux'], so that the fluxes are proportinal to the total area.
+
+    #our target star
+    if plot_target:
+        plt.scatter(pixel_coords[idx_target][0]+column, pixel_coords[idx_target][1]+row,
+                    s = (scale_factor*flux[idx_target]), c = '#25BDB0', ec = 'k', lw = 1.5,
+                    alpha = 0.8, zorder = 99, label = target_name)
+
+    #the N most contaminant sources
+    if plot_main_contaminants:
+        #same colors as in the bar of the pie chart, where the sources are sorted by contamination
+        labels_ordered = [label for height, label in sorted([*zip(relative_contam, labels)])][::-1]
+        idx_other = labels_ordered.index('Other')
+        heat_colors =  get_hex_color_list(num_colors = n_sources+1, saturation = 0.5, value = 1.0)
+        heat_colors = heat_colors[::-1]
+        heat_colors.pop(idx_other)
+        for i,index in reversed(list(enumerate(idxs_selected))):
+            plt.scatter(pixel_coords[index][0]+column, pixel_coords[index][1]+row,
+                        s = (scale_factor*flux[index]), c = heat_colors[i], alpha = 0.6, ec = 'k',
+                       zorder = 100000, label = labels[i])
+
+    #all the remaining Gaia DR3 sources
+    if plot_all_gaia:
+        plt.scatter(pixel_coords[:,0]+column, pixel_coords[:,1]+row, s = (scale_factor*np.asarray(flux)),
+                    c = 'lightgrey', ec = 'w', alpha = 0.3, zorder = 98, rasterized = rasterized)
+
+    plt.ylim(row+ny-0.5, row-0.5)
+    plt.xlim(column-0.5, column+nx-0.5)
+
+    #to fix marker sizes for the legend
+    #see https://stackoverflow.com/questions/24706125/setting-a-fixed-size-for-points-in-legend
+    legend_marker_size = 60
+    def updatescatter(handle, orig):
+        handle.update_from(orig)
+        handle.set_sizes([legend_marker_size])
+    plt.legend(loc = loc_legend, handler_map={PathCollection : HandlerPathCollection(update_func=updatescatter)},
+               framealpha=0.9, fontsize = 12).set_zorder(10000)
+
+    #--------
+    #COLORBAR
+    #--------
+    cbax = plt.subplot(gs[0,1]) # Place it where it should be.
+    pos1 = cbax.get_position() # get the original position
+    pos2 = [pos1.x0 - 0.075, pos1.y0, pos1.width, pos1.height]
+    cbax.set_position(pos2) # set a new position
+
+    cb = Colorbar(ax = cbax, mappable = splot, orientation = 'vertical',
+                  ticklocation = 'right')
+
+    if plot_target_name:
+        cb.set_label(f'Flux ratio from {target_name} (%)', labelpad=10, fontsize=14)
+    else:
+        cb.set_label('Flux ratio from the target star (%)', labelpad=10, fontsize=14)
+    return fig
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rendering of the TESS-cont figures in background worker processes.
+
+    python -m tesscont.render FILES [--workers 4]
+
+render_figures draws and saves the pie chart and heatmap of a
+ContaminationResult (see tesscont/plots.py). A Renderer is a pool of worker
+processes (forked when the Renderer is created, with the non-interactive
+Agg backend) that draws the figures of each submitted result while the
+caller moves on to the next target; at most `max_pending` results are
+queued or being drawn, and submit blocks beyond that, which caps the memory
+held by the queue. The batch runner (tesscont/batch.py) runs TESS-cont.py
+with a Renderer active, so that TESS-cont.py hands its figures over to it.
+
+The figures can also be deferred entirely: with `render: deferred`,
+TESS-cont.py saves the result and the figure options to
+`<target_name>_S<sector>_figures.pkl` (see save_figures), and FILES of
+this kind are drawn later with the command above.
+"""
+import os
+import sys
+import pickle
+import argparse
+import threading
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from PRF.parallel import pool_context
+from .batch import use_agg
+
+def render_figures(result, basename, target_name, img_fmt='pdfpng', n_sources=5, **heatmap_options):
+    """Draw and save the pie chart and heatmap of a result
+
+    inputs:
+     - result (ContaminationResult)
+     - basename (str): the figures are saved as basename_piechart.pdf/png
+       and basename_heatmap.pdf/png
+     - target_name (str): name of the target, for the heatmap legend
+     - img_fmt (str, default 'pdfpng'): 'pdf', 'png', or 'pdfpng'
+     - n_sources (int, default 5): number of contaminant sources to highlight
+     - heatmap_options: other options of plots.plot_heatmap
+
+    returns the saved file names
+    """
+    import matplotlib.pyplot as plt
+    from . import plots
+
+    fig = plots.plot_piechart(result, n_sources=n_sources)
+    paths = plots.save_figure(fig, basename + '_piechart', img_fmt)
+    plt.close(fig)
+    fig = plots.plot_heatmap(result, target_name, n_sources=n_sources, **heatmap_options)
+    paths += plots.save_figure(fig, basename + '_heatmap', img_fmt)
+    plt.close(fig)
+    return paths
+
+def save_figures(path, result, basename, target_name, img_fmt='pdfpng', **options):
+    """Save a result with its figure options (see render_figures), to draw the figures later"""
+    with open(path, 'wb') as f:
+        pickle.dump({'result': result, 'basename': basename, 'target_name': target_name,
+                     'img_fmt': img_fmt, 'options': options}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_figures(path):
+    """Result and figure options saved with save_figures, as arguments of render_figures"""
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    return dict(result=saved['result'], basename=saved['basename'], target_name=saved['target_name'],
+                img_fmt=saved['img_fmt'], **saved['options'])
+
+#Renderer in use by this process (see active_renderer)
+_active = None
+
+def active_renderer():
+    """The Renderer of this process, if any (TESS-cont.py submits its figures to it)"""
+    #forked workers (e.g. of the multi-sector mode) inherit a copy of the
+    #parent's Renderer, which they cannot submit to
+    if _active is not None and _active.pid == os.getpid():
+        return _active
+    return None
+
+class Renderer:
+    """Pool of worker processes drawing the figures of TESS-cont in the background
+
+    inputs:
+     - n_workers (int, default 1): worker processes; with 0 (or where fork is
+       not available), the figures are drawn by submit itself
+     - max_pending (int, default 4): maximum number of results queued or
+       being drawn; submit waits for a free slot beyond that
+
+    Used as a context manager, it is the active renderer of the process (see
+    active_renderer) inside the `with` block, and waits for all the figures
+    on exit. The file names of the figures that could not be drawn are then
+    in `failed`, with the error.
+    """
+    def __init__(self, n_workers=1, max_pending=4):
+        self.pid = os.getpid()
+        self.failed = []
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max(int(max_pending), 1))
+        self._executor = None
+        context = pool_context() if n_workers > 0 else None
+        if context is not None:
+            self._executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=use_agg)
+            #the workers are forked now, before this process loads any target
+            self._executor.submit(os.getpid).result()
+
+    def submit(self, result, basename, target_name, img_fmt='pdfpng', **options):
+        """Draw the figures of a result (arguments as in render_figures) in the background"""
+        if self._executor is None:
+            try:
+                render_figures(result, basename, target_name, img_fmt, **options)
+            except Exception as e:
+                self.failed.append((basename, f'{type(e).__name__}: {e}'))
+            return None
+        self._slots.acquire()
+        future = self._executor.submit(render_figures, result, basename, target_name, img_fmt, **options)
+        future.add_done_callback(lambda future: self._slots.release())
+        self._futures.append((basename, future))
+        return future
+
+    def close(self):
+        """Wait for all the figures, and stop the workers; returns `failed`"""
+        for basename, future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.failed.append((basename, f'{type(e).__name__}: {e}'))
+        self._futures = []
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return self.failed
+
+    def __enter__(self):
+        global _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+        self.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m tesscont.render',
+                                     description='Draw the figures saved by TESS-cont runs with render: deferred.')
+    parser.add_argument('files', nargs='+',
+                        help='_figures.pkl files, or directories to search (recursively) for them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--max_pending', type=int, default=None,
+                        help='maximum number of results held in memory (default: twice the workers)')
+    args = parser.parse_args()
+
+    paths = []
+    for name in args.files:
+        if os.path.isdir(name):
+            paths += sorted(glob(os.path.join(name, '**', '*_figures.pkl'), recursive=True))
+        else:
+            paths.append(name)
+    use_agg()
+    with Renderer(args.workers, args.max_pending or 2*args.workers) as renderer:
+        for path in paths:
+            renderer.submit(**load_figures(path))
+    for basename, message in renderer.failed:
+        print(f'FAILED {basename}: {message}')
+    print(f'The figures of {len(paths) - len(renderer.failed)} of {len(paths)} results have been drawn')
+    sys.exit(int(len(renderer.failed) > 0))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-sector mode: analyse every TESS sector of a target in one go.
+
+With `sector: all` in the OPTIONAL section, TESS-cont.py calls run_sectors,
+which finds all the sectors with a TPF (or tesscut) of the target, queries
+Gaia and resolves the TIC once (filling the local caches, see
+tesscont/gaia.py and tesscont/tic.py; with `gaia_cache: False`, the Gaia
+query goes to a cache private to this run, in output/<target_name>/sectors,
+which the sectors are pointed at), and then runs TESS-cont.py on every
+sector in parallel worker processes (forked: TESS-cont.py has no
+`__main__` guard, so other start methods would re-run it in every worker;
+where fork is not available, the sectors are run one after the other). Each sector re-uses the cached Gaia
+sources, propagated to its own epoch, and writes its usual plots and
+files, plus a one-row `<target_name>_S<sector>_metrics.csv`. These are
+finally gathered into a single `<target_name>_metrics.csv` table.
+"""
+import os
+import re
+from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor
+from .batch import SCRIPT, run_config, use_agg
+from .metrics import deferred_export
+from PRF.parallel import pool_context
+
+def available_sectors(target, tpf_or_tesscut='tpf'):
+    """Sectors with a TPF (or tesscut) of a target, and its coordinates
+
+    returns (sorted list of sectors, ra, dec); ra and dec are None if the
+    search results do not provide them
+    """
+    import lightkurve as lk
+    if tpf_or_tesscut == 'tesscut':
+        search_result = lk.search_tesscut(str(target))
+    else:
+        search_result = lk.search_targetpixelfile(str(target))
+    sectors = set()
+    for mission in search_result.mission:
+        match = re.search(r'Sector\s*(\d+)', str(mission))
+        if match:
+            sectors.add(int(match.group(1)))
+    ra = dec = None
+    if len(search_result) > 0 and 's_ra' in search_result.table.colnames:
+        ra, dec = float(search_result.table['s_ra'][0]), float(search_result.table['s_dec'][0])
+    return sorted(sectors), ra, dec
+
+def _run_sector(path, script):
+    #worker processes cannot show figures
+    use_agg()
+    return run_config(path, script=script)
+
+def run_sectors(config_path, target, target_name, tpf_or_tesscut='tpf', search_radius=50.,
+                gaia_catalog='DR3', gaia_backend='vizier', gaia_localdir=None, gaia_cache=True,
+                gaia_cachedir=None, save_metrics=True, n_workers=None, metrics_only=False, script=SCRIPT):
+    """Run TESS-cont.py on all the sectors of a target
+
+    inputs:
+     - config_path (str): configuration file (with `sector: all`)
+     - target, target_name, tpf_or_tesscut, search_radius, gaia_catalog,
+       gaia_backend, gaia_localdir, gaia_cache, gaia_cachedir: as in the
+       configuration file. The Gaia sources are queried once here, and the
+       sectors read them from the cache (from a cache private to this run,
+       if gaia_cache is False)
+     - save_metrics (bool, default True): record the metrics of every sector
+       in the metrics store, and export metrics.dat once all sectors are done
+     - n_workers (int, default None): worker processes (default: the number
+       of CPUs), split between the sectors and then the sources of each one
+     - metrics_only (bool, default False): no figures in the runs of each sector
+     - script (str): TESS-cont.py script to run
+
+    returns (metrics, failed): a pandas DataFrame with the metrics of each
+    sector (None if none was written), and a list of (sector, message) with
+    the sectors that failed
+    """
+    import pandas as pd
+    from .gaia import query_gaia
+    from .tic import resolve_gaia_ids
+
+    sectors, ra, dec = available_sectors(target, tpf_or_tesscut)
+    if len(sectors) == 0:
+        print(f'Error: There are no TESS data of {target}')
+        return None, []
+    print(f'{target_name} was observed in {len(sectors)} sectors: {", ".join(map(str, sectors))}')
+
+    outdir = os.path.join('output', target_name)
+    configdir = os.path.join(outdir, 'sectors')
+    os.makedirs(configdir, exist_ok=True)
+
+    #one Gaia query and one TIC resolution for all sectors: the runs of each
+    #sector find them in the local caches (a slightly larger cone is queried
+    #so that it contains the cone around each sector's TPF)
+    shared_cachedir = None
+    if ra is not None and gaia_backend != 'local':
+        if not gaia_cache:
+            #the user's cache is left untouched
+            shared_cachedir = os.path.join(configdir, 'gaia_cache')
+        query_gaia(ra, dec, search_radius + 10., catalog=gaia_catalog, cachedir=shared_cachedir or gaia_cachedir,
+                   backend=gaia_backend)
+    match = re.match(r'^TIC\s*(\d+)$', str(target).strip())
+    if match:
+        try:
+            resolve_gaia_ids([match.group(1)])
+        except Exception as e:
+            print(f'The Gaia ID of {target} could not be obtained from MAST ({e})')
+
+    #the workers are split between sectors, and the sources of each sector
+    total_workers = max(int(n_workers), 1) if n_workers is not None else os.cpu_count() or 1
+    n_workers = min(total_workers, len(sectors))
+
+    #one configuration file per sector
+    paths = []
+    for sector in sectors:
+        config = ConfigParser()
+        config.read(config_path)
+        config['OPTIONAL']['sector'] = str(sector)
+        config['OPTIONAL']['save_metrics'] = str(bool(save_metrics))
+        config['OPTIONAL']['n_workers'] = str(max(total_workers // n_workers, 1))
+        if metrics_only:
+            config['OPTIONAL']['metrics_only'] = 'True'
+        if shared_cachedir is not None:
+            config['OPTIONAL']['gaia_cache'] = 'True'
+            config['OPTIONAL']['gaia_cachedir'] = shared_cachedir
+        path = os.path.join(configdir, f'{target_name}_S{sector}.ini')
+        with open(path, 'w') as f:
+            config.write(f)
+        paths.append(path)
+
+    #each sector records its metrics in the metrics store, and metrics.dat is exported once at the end
+    context = pool_context()
+    with deferred_export(export=save_metrics):
+        if n_workers > 1 and context is not None:
+            print(f'Processing {len(paths)} sectors with {n_workers} workers ...')
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+                results = list(executor.map(_run_sector, paths, [script]*len(paths)))
+        else:
+            results = [run_config(path, script=script) for path in paths]
+    failed = [(sector, message) for sector, (status, message, seconds) in zip(sectors, results) if status != 'ok']
+    for sector, message in failed:
+        print(f'  Sector {sector} FAILED: {message}')
+
+    #multi-sector metrics table
+    files = [os.path.join(outdir, f'{target_name}_S{sector}_metrics.csv')
+             for sector, (status, message, seconds) in zip(sectors, results) if status == 'ok']
+    files = [file for file in files if os.path.exists(file)]
+    if len(files) == 0:
+        return None, failed
+    metrics = pd.concat([pd.read_csv(file) for file in files], ignore_index=True)
+    metrics = metrics.sort_values('sector')
+    metrics.to_csv(os.path.join(outdir, f'{target_name}_metrics.csv'), index=False)
+    print('\033[1m' + f'The metrics of all sectors have been saved in {target_name}_metrics.csv' + '\033[0m')
+    print(metrics.to_string(index=False))
+    return metrics, failed
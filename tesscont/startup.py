@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup-time budget of TESS-cont.
+
+    python -m tesscont.startup [--repeat 5] [--library 0.5] [--cli 1.5]
+
+measures, in fresh interpreters, the time to `import PRF, tesscont` (what
+the library API, batch workers and the multi-sector parent pay) and to
+start TESS-cont.py (`TESS-cont.py --help`: the imports and argument parsing
+that every run pays before any work). The best of --repeat runs is compared
+to the budgets (in seconds), the slowest imported modules are listed, and
+the exit code is 1 if any budget is exceeded. Heavy modules (lightkurve,
+matplotlib, astroquery, requests, scipy) must be imported inside the code
+paths that need them, and not at module level.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from .batch import SCRIPT
+
+#seconds, on a typical workstation
+LIBRARY_BUDGET = 0.5
+CLI_BUDGET = 1.5
+
+def measure(command, repeat=5):
+    """Best wall time [s] of running command (a list) in a fresh process"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       cwd=os.path.dirname(SCRIPT))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def slowest_imports(statement, n=10):
+    """The n modules with the largest cumulative import time [s] for a statement"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, cwd=os.path.dirname(SCRIPT))
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times.append((int(cumulative)/1e6, module.strip()))
+    return sorted(times, reverse=True)[:n]
+
+def check_startup(library=LIBRARY_BUDGET, cli=CLI_BUDGET, repeat=5):
+    """Measure the startup times; returns True if they are within the budgets"""
+    ok = True
+    for name, command, budget in [('import PRF, tesscont', [sys.executable, '-c', 'import PRF, tesscont'], library),
+                                  ('TESS-cont.py --help', [sys.executable, SCRIPT, '--help'], cli)]:
+        seconds = measure(command, repeat=repeat)
+        within = seconds <= budget
+        ok &= within
+        print(f'{name:22s} {seconds:6.3f} s  (budget {budget:.3f} s)  {"ok" if within else "OVER BUDGET"}')
+    print('\nSlowest imports of PRF and tesscont (cumulative):')
+    for seconds, module in slowest_imports('import PRF, tesscont'):
+        print(f'  {seconds:6.3f} s  {module}')
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m tesscont.startup',
+                                     description='Measure the startup time of TESS-cont against a budget.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--library', type=float, default=LIBRARY_BUDGET,
+                        help='budget of import PRF, tesscont [s]')
+    parser.add_argument('--cli', type=float, default=CLI_BUDGET, help='budget of TESS-cont.py --help [s]')
+    args = parser.parse_args()
+    sys.exit(0 if check_startup(args.library, args.cli, args.repeat) else 1)
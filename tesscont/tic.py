@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TIC to Gaia ID cross-match, with a persistent local map.
+
+The Gaia (DR2) ID of each TIC resolved on MAST is stored in a small SQLite
+database under the TESS-cont cache directory (see tesscont/gaia.py), which
+is consulted before querying MAST. Many TICs can be resolved with a single
+MAST query (resolve_gaia_ids), e.g. before processing a batch of targets,
+and crossmatch_gaia finds the target in an already downloaded Gaia table
+from its position alone, so that a run can proceed without any MAST call.
+"""
+import os
+import sqlite3
+import numpy as np
+from .gaia import default_cachedir
+
+class TICGaiaMap:
+    """Persistent map of TIC IDs to Gaia IDs
+
+    """
+    def __init__(self, cachedir=None):
+        """Open (and create, if needed) the map.
+
+        inputs:
+         - cachedir (str, default None): cache root directory (see default_cachedir)
+        """
+        directory = cachedir or default_cachedir()
+        os.makedirs(directory, exist_ok=True)
+        self.database = os.path.join(directory, 'tic_gaia.sqlite')
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS tic_gaia '
+                               '(tic TEXT PRIMARY KEY, gaia INTEGER)')
+
+    def _connect(self):
+        #several processes may use the map at the same time
+        return sqlite3.connect(self.database, timeout=60)
+
+    def get(self, tics):
+        """dict {tic: Gaia ID} of the given TICs that are in the map
+
+        TICs known to have no Gaia counterpart map to None.
+        """
+        tics = [str(tic) for tic in tics]
+        found = {}
+        with self._connect() as connection:
+            #chunks, to stay below the SQLite limit of query parameters
+            for i in range(0, len(tics), 500):
+                chunk = tics[i:i+500]
+                query = ('SELECT tic, gaia FROM tic_gaia WHERE tic IN (' +
+                         ','.join('?'*len(chunk)) + ')')
+                found.update(connection.execute(query, chunk).fetchall())
+        return found
+
+    def put(self, ids):
+        """Store a dict {tic: Gaia ID or None}"""
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO tic_gaia VALUES (?, ?)',
+                                   [(str(tic), None if gaia is None else int(gaia))
+                                    for tic, gaia in ids.items()])
+
+def _gaia_id(value):
+    #Gaia IDs are strings in the TIC, empty if there is no counterpart
+    value = str(np.ma.filled(value, ''))
+    return int(value) if value not in ['', 'nan', '--'] else None
+
+def resolve_gaia_ids(tics, cache=True, cachedir=None):
+    """Gaia (DR2) IDs of many TICs, querying MAST once for the unknown ones
+
+    inputs:
+     - tics (iterable): TIC IDs (int or str, without the 'TIC' prefix)
+     - cache (bool, default True): use (and fill) the local TIC-Gaia map
+     - cachedir (str, default None): cache root directory
+
+    returns a dict {tic (str): Gaia ID, or None if the TIC has none}
+    """
+    tics = [str(tic) for tic in tics]
+    ticmap = TICGaiaMap(cachedir) if cache else None
+    ids = ticmap.get(tics) if cache else {}
+    missing = [tic for tic in tics if tic not in ids]
+    if len(missing) > 0:
+        from astroquery.mast import Catalogs
+        result = Catalogs.query_criteria(catalog='Tic', ID=[int(tic) for tic in missing])
+        new = {tic: None for tic in missing}
+        for tic, gaia in zip(result['ID'], result['GAIA']):
+            new[str(tic)] = _gaia_id(gaia)
+        if cache:
+            ticmap.put(new)
+        ids.update(new)
+    return {tic: ids[tic] for tic in tics}
+
+def get_gaia_id(tic, cache=True, cachedir=None):
+    """Gaia (DR2) ID of a TIC (None if it has none), from the local map or MAST"""
+    tic = str(tic)
+    ticmap = TICGaiaMap(cachedir) if cache else None
+    ids = ticmap.get([tic]) if cache else {}
+    if tic not in ids:
+        #modified from tpfplotter (https://github.com/jlillo/tpfplotter)
+        from astroquery.mast import Catalogs
+        result = Catalogs.query_object('TIC'+tic, radius=.005, catalog="TIC")
+        IDs = np.asarray(result['ID']).astype(str)
+        k = np.where(IDs == tic)[0][0]
+        ids[tic] = _gaia_id(result['GAIA'][k])
+        if cache:
+            ticmap.put({tic: ids[tic]})
+    return ids[tic]
+
+def crossmatch_gaia(table, ra, dec, epoch=2000., catalog='DR3', max_separation=3.):
+    """Index of the Gaia source closest to a position (e.g. the TIC position)
+
+    inputs:
+     - table (astropy Table): Gaia sources (RA_ICRS, DE_ICRS, pmRA, pmDE)
+     - ra, dec (float): position of the target [deg]
+     - epoch (float, default 2000): epoch of (ra, dec) [yr]; the TIC (and
+       the TPF headers) use J2000 positions
+     - catalog (str, default 'DR3'): Gaia data release of the table
+     - max_separation (float, default 3): maximum separation [arcsec]
+
+    returns the index in `table`, or None if no source is close enough
+    """
+    gaia_epoch = 2016. if catalog == 'DR3' else 2015.5
+    dt = epoch - gaia_epoch
+    pmra = np.nan_to_num(np.ma.filled(np.ma.asarray(table['pmRA'], dtype=float), 0.))
+    pmde = np.nan_to_num(np.ma.filled(np.ma.asarray(table['pmDE'], dtype=float), 0.))
+    decs = np.ma.filled(np.ma.asarray(table['DE_ICRS'], dtype=float), np.nan) + pmde/3600000*dt
+    ras = (np.ma.filled(np.ma.asarray(table['RA_ICRS'], dtype=float), np.nan) +
+           pmra/3600000*dt/np.cos(np.radians(decs)))
+
+    #angular distance (haversine)
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    hav = (np.sin((np.radians(decs) - dec0)/2)**2 +
+           np.cos(np.radians(decs))*np.cos(dec0)*np.sin((np.radians(ras) - ra0)/2)**2)
+    separation = np.degrees(2*np.arcsin(np.sqrt(np.clip(hav, 0, 1))))*3600
+    if not np.any(separation <= max_separation):
+        return None
+    return int(np.nanargmin(separation))